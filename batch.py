@@ -0,0 +1,280 @@
+import numpy as np
+
+from baumwelch import BaumWelchStatistics
+from maths import shifted_exp
+from parameters import as_state_parameters
+from profiling import profiled
+from topology import as_transitions
+
+
+def pad_sequences(sequences: list):
+    """Pack ragged observation sequences into a zero padded B x T_max (x D) array and their lengths
+
+    raises ValueError for an empty sequence, it has no likelihood to score or train on
+    """
+
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=int)
+    check_lengths(lengths)
+    feature_shape = np.shape(sequences[0])[1:] if len(sequences) else ()
+    padded = np.zeros((len(sequences), np.max(lengths, initial=0)) + feature_shape)
+
+    for index, sequence in enumerate(sequences):
+        padded[index, :lengths[index]] = sequence
+
+    return padded, lengths
+
+
+def check_lengths(lengths):
+    """ValueError naming the first zero-length sequence, one would turn the whole batch's sums to -inf/nan"""
+    empty = np.flatnonzero(np.asarray(lengths) <= 0)
+    if len(empty):
+        raise ValueError('sequence {} has no observations, empty sequences are not supported'.format(empty[0]))
+
+
+class BatchMarkovModel:
+    """Scaled forward/backward over a batch of observation sequences of different lengths at once
+
+    Lattices are T_max x B x N (time, sequence, state) so each time step is one contiguous B x N
+    block, padded frames past a sequence's length hold zero forward/backward/occupation.
+    dtype sets the lattice/emission precision, sums are accumulated in float64 as in MarkovModel
+    """
+
+    def __init__(self, states: list, sequences: list = list(), state_transitions: list = list(),
+                 lengths: list = None, mask: np.ndarray = None, profiler=None, dtype=float):
+        self.profiler = profiler # profiling.Profiler, None keeps instrumentation off
+        self.dtype = np.dtype(dtype)
+        self.state_transitions = state_transitions
+        # ^ padded by entry and exit probs (or BandedTransitions), same layout as MarkovModel
+
+        self.states = states
+        self.set_sequences(sequences, lengths=lengths, mask=mask)
+
+    def set_sequences(self, sequences: list, lengths: list = None, mask: np.ndarray = None):
+        """Load a new batch, either ragged sequences or a padded B x T_max array with lengths or a mask
+
+        a mask marks valid frames and must be a prefix of each row (frames after the first False are ignored)
+        """
+
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            lengths = np.argmin(np.concatenate([mask, np.zeros((len(mask), 1), dtype=bool)], axis=1), axis=1)
+
+        if lengths is None:
+            observations, lengths = pad_sequences(sequences)
+        else:
+            observations = np.asarray(sequences, dtype=float)
+            lengths = np.asarray(lengths, dtype=int)
+            check_lengths(lengths)
+
+        self.observations = observations
+        self.lengths = lengths
+        self.mask = np.arange(observations.shape[1])[np.newaxis, :] < lengths[:, np.newaxis]
+        self._emission = None # new shape, buffer reallocated
+        self._emission_valid = False
+        self.emission_cache = {}
+        self.allocate_lattices()
+
+        self.exit_scale = np.ones(len(lengths))
+        self.log_likelihood = np.zeros(len(lengths))
+
+    def allocate_lattices(self):
+        """(Re)allocate T_max x B x N lattice buffers when the batch shape or state count changes"""
+        shape = (self.observations.shape[1], self.observations.shape[0], len(self.parameters))
+        if getattr(self, 'forward', None) is None or self.forward.shape != shape:
+            self.forward = np.zeros(shape, dtype=self.dtype)
+            self.backward = np.zeros(shape, dtype=self.dtype)
+            self.occupation = np.zeros(shape, dtype=self.dtype)
+            self.scale = np.ones(shape[:2], dtype=self.dtype)
+            if self.profiler is not None:
+                self.profiler.allocated(self.forward, self.backward, self.occupation, self.scale)
+
+    @property
+    def states(self):
+        return self._states
+
+    @states.setter
+    def states(self, value):
+        """Set state parameters (State list or StateParameters), invalidates cached emission likelihoods"""
+        previous = getattr(self, 'parameters', None)
+        self._states = value
+        self.parameters = as_state_parameters(value)
+        self._emission_valid = False
+        self.emission_cache = {}
+        if previous is not None and len(previous) != len(self.parameters):
+            self._emission = None # new state count, emission and lattice buffers reallocated
+            self.allocate_lattices()
+
+    @property
+    def emission(self):
+        """T_max x B x N output probability densities for every frame of every sequence, cached
+
+        rebuilt into the same buffer when only the states change (every training iteration), mixture
+        component densities are kept in emission_cache until the next accumulate(). Each frame is stored
+        relative to its largest density, emission_shift (T_max x B, float64) keeps the ln of it
+        """
+        if not self._emission_valid:
+            allocating = self._emission is None
+            if allocating:
+                self._emission = np.empty(self.forward.shape, dtype=self.dtype)
+            self.emission_cache = {}
+            with profiled(self.profiler, 'emission'):
+                log_emission = self.parameters.log_emission(self.frames(), state_axis=-1, cache=self.emission_cache)
+                self._emission, self.emission_shift = shifted_exp(log_emission, axis=-1, out=self._emission)
+            self._emission_valid = True
+
+            if self.profiler is not None:
+                # padded frames are evaluated too, they're part of the cost
+                self.profiler.count('emission_evaluations', self._emission.size)
+                if allocating:
+                    self.profiler.allocated(self._emission)
+        return self._emission
+
+    def frames(self):
+        """Observations time major, T_max x B (x D) to line up with the lattices"""
+        return np.swapaxes(self.observations, 0, 1)
+
+    @property
+    def state_transitions(self):
+        return self.transitions.padded
+
+    @state_transitions.setter
+    def state_transitions(self, value):
+        self.transitions = as_transitions(value)
+        self.recursion_transitions = self.transitions.astype(self.dtype) # matches the lattices
+
+    @property
+    def entry_probabilities(self):
+        return self.transitions.entry
+
+    @property
+    def exit_probabilities(self):
+        return self.transitions.exit
+
+    @property
+    def transition_matrix(self):
+        return self.transitions.matrix
+
+    @property
+    def observation_likelihood(self):
+        """ln(P(O|model)) summed over every sequence in the batch"""
+        return np.sum(self.log_likelihood)
+
+    def populate(self):
+        """Calculate scaled forward/backward, every sequence's ln(P(O|model)) and occupation
+
+        the lower precision recursion transitions are rebuilt, so in-place edits are picked up
+        """
+
+        self.state_transitions = self.transitions.refreshed()
+        self.emission # built (and profiled) up front rather than inside the forward phase
+
+        with profiled(self.profiler, 'forward'):
+            self.populate_forward()
+        with profiled(self.profiler, 'backward'):
+            self.populate_backward()
+        with profiled(self.profiler, 'occupation'):
+            self.populate_occupation()
+        return self
+
+    ####################################
+    #           Likelihoods
+    ####################################
+
+    def populate_forward(self):
+        """Populate scaled forward likelihoods for every sequence, one B x N update per time step"""
+
+        if self.observations.shape[1] == 0:
+            return self.forward
+
+        transitions = self.recursion_transitions
+        emission = self.emission
+
+        for t in range(self.observations.shape[1]):
+            if t == 0:
+                column = self.entry_probabilities * emission[0]
+            else:
+                column = transitions.forward(self.forward[t - 1]) * emission[t]
+
+            # finished sequences keep a unit scale and zero forward
+            active = self.mask[:, t]
+            self.scale[t] = np.where(active, np.sum(column, axis=1), 1.)
+            np.divide(column, self.scale[t][:, np.newaxis], out=self.forward[t])
+            self.forward[t][~active] = 0
+
+        # exit probs normalised as a final frame at each sequence's own end
+        batch = np.arange(len(self.lengths))
+        self.exit_scale = self.forward[self.lengths - 1, batch] @ self.exit_probabilities
+        self.log_likelihood = np.sum(np.log(self.scale), axis=0, dtype=float) + np.log(self.exit_scale)
+        self.log_likelihood += np.sum(self.emission_shift, axis=0, where=self.mask.T) # shifts scale absorbed
+
+        return self.forward
+
+    def populate_backward(self):
+        """Populate scaled backward likelihoods, reusing the forward normalisers"""
+
+        if self.observations.shape[1] == 0:
+            return self.backward
+
+        transitions = self.recursion_transitions
+        emission = self.emission
+        final = self.exit_probabilities[np.newaxis, :] / self.exit_scale[:, np.newaxis]
+
+        for t in range(self.observations.shape[1] - 1, -1, -1):
+            if t + 1 < self.observations.shape[1]:
+                # sum_j( a_ij * b_j(o_t+1) * beta_j(t+1) ) / c_t+1 for every sequence/state
+                column = transitions.backward(emission[t + 1] * self.backward[t + 1]) / self.scale[t + 1][:, np.newaxis]
+            else:
+                column = np.zeros_like(final)
+
+            last = (self.lengths - 1 == t)[:, np.newaxis]
+            self.backward[t] = np.where(last, final, column)
+            self.backward[t][~self.mask[:, t]] = 0
+
+        return self.backward
+
+    def populate_occupation(self):
+        """Populate occupation likelihoods for every sequence, padded frames stay zero"""
+
+        np.multiply(self.forward, self.backward, out=self.occupation)
+        return self.occupation
+
+    def transition_sums(self):
+        """Transition likelihoods summed over every frame of every sequence, in the topology's layout"""
+
+        length = len(self.states)
+        weighted_backward = self.emission[1:] * self.backward[1:] / self.scale[1:, :, np.newaxis]
+
+        # a_ij * sum_b,t( alpha_i(t-1) * b_j(o_t) * beta_j(t) / c_t ), padded frames have beta = 0
+        return self.transitions.transition_sums(np.asarray(self.forward[:-1].reshape(-1, length), dtype=float),
+                                                np.asarray(weighted_backward.reshape(-1, length), dtype=float))
+
+    ####################################
+    #     Baum-Welch Re-estimations
+    ####################################
+
+    def accumulate(self):
+        """Baum-Welch sufficient statistics summed over the whole batch"""
+
+        with profiled(self.profiler, 'accumulate'):
+            # padded frames carry zero occupation so can be summed over with the rest
+            length = len(self.states)
+            frames = self.frames()
+            emission_statistics = self.parameters.weighted_statistics(self.occupation.reshape(-1, length), 
+                                                                      frames.reshape((-1,) + frames.shape[2:]),
+                                                                      cache=self.emission_cache)
+            self.emission_cache.clear() # E-step done, don't hold component densities past it
+
+            return BaumWelchStatistics(occupation=np.sum(self.occupation, axis=(0, 1), dtype=float),
+                                       transitions=self.transition_sums(),
+                                       entry=np.sum(self.occupation[0], axis=0, dtype=float),
+                                       exit=np.sum(self.occupation[self.lengths - 1, np.arange(len(self.lengths))], axis=0, dtype=float),
+                                       sequences=len(self.lengths),
+                                       **emission_statistics)
+
+    def reestimate(self):
+        """One Baum-Welch M-step over the batch, returns new means, variances and state transitions (same topology)"""
+
+        statistics = self.accumulate()
+        return (statistics.reestimated_mean(),
+                statistics.reestimated_variance(),
+                self.transitions.reestimated(statistics))
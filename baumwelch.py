@@ -0,0 +1,75 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+
+def per_state_average(weighted, occupation_sum):
+    """Divide N (x ...) occupation weighted sums by each state's (or N x M mixture component's) total occupation"""
+    return weighted / occupation_sum.reshape(occupation_sum.shape + (1,) * (np.ndim(weighted) - np.ndim(occupation_sum)))
+
+
+@dataclass
+class BaumWelchStatistics:
+    """Sufficient statistics for one Baum-Welch update, summed over time (and sequences with +)"""
+    occupation: np.ndarray  # sum_t( L_j(t) ), N
+    weighted_observations: np.ndarray  # sum_t( L_j(t) * o_t ), N (x D)
+    weighted_squares: np.ndarray  # sum_t( L_j(t) * (o_t - mean_j)^2 ), N (x D (x D)), about the current means
+    transitions: np.ndarray  # sum_t( xi_ij(t) ), N x N
+    entry: np.ndarray  # L_j(0), N
+    exit: np.ndarray  # L_j(T), N
+    sequences: int = 1
+    component_occupation: np.ndarray = None  # sum_t( L_jm(t) ), N x M, mixture states only, then weighted sums are per component
+
+    @classmethod
+    def from_posteriors(cls, occupation, transition_sums, observations, parameters, cache: dict = None):
+        """Build statistics for one sequence from its N x T occupation and N x N summed transition likelihoods
+
+        cache is the engine's emission cache, see StateParameters.log_emission()
+        """
+        occupation = np.asarray(occupation, dtype=float)
+
+        return cls(occupation=np.sum(occupation, axis=1),
+                   transitions=None if transition_sums is None else np.asarray(transition_sums, dtype=float),
+                   entry=occupation[:, 0],
+                   exit=occupation[:, -1],
+                   **parameters.weighted_statistics(occupation.T, observations, cache=cache))
+
+    def __add__(self, other):
+        return BaumWelchStatistics(occupation=self.occupation + other.occupation,
+                                   weighted_observations=self.weighted_observations + other.weighted_observations,
+                                   weighted_squares=self.weighted_squares + other.weighted_squares,
+                                   transitions=self.transitions + other.transitions,
+                                   entry=self.entry + other.entry,
+                                   exit=self.exit + other.exit,
+                                   sequences=self.sequences + other.sequences,
+                                   component_occupation=None if self.component_occupation is None 
+                                                        else self.component_occupation + other.component_occupation)
+
+    @property
+    def emission_occupation(self):
+        """Denominator for the gaussian re-estimates, per state or per mixture component"""
+        return self.occupation if self.component_occupation is None else self.component_occupation
+
+    def reestimated_mean(self):
+        """sum( occupation * observation ) / sum( occupation ) for every state (or mixture component)"""
+        return per_state_average(self.weighted_observations, self.emission_occupation)
+
+    def reestimated_variance(self):
+        """sum( occupation * (observation - mean)^2 ) / sum( occupation ) for every state (or mixture component)"""
+        return per_state_average(self.weighted_squares, self.emission_occupation)
+
+    def reestimated_weights(self):
+        """Mixture weights, each component's share of its state's occupation"""
+        return self.component_occupation / self.occupation[:, np.newaxis]
+
+    def reestimated_state_transitions(self):
+        """Re-estimated padded state transitions, entry row, a_ij block and exit column"""
+
+        length = len(self.occupation)
+        new_transitions = np.zeros((length + 2, length + 2))
+
+        new_transitions[0, 1:length + 1] = self.entry / self.sequences # pi
+        new_transitions[1:length + 1, 1:length + 1] = self.transitions / self.occupation[:, np.newaxis] # a_ij
+        new_transitions[1:length + 1, -1] = self.exit / self.occupation # eta
+
+        return new_transitions
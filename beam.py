@@ -0,0 +1,166 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+from parameters import StateParameters, as_state_parameters
+from topology import DenseTransitions, as_transitions
+from viterbi import backpointer_dtype
+
+
+@dataclass(frozen=True)
+class BeamResult:
+    log_likelihood: float  # ln(P(O|model)) over the pruned lattice (forward), best path score (viterbi)
+    active_counts: np.ndarray  # states kept after pruning at every frame, T
+    path: np.ndarray = None  # best state index for every observation, viterbi only
+
+
+def candidate_log_emission(parameters, observation, indices):
+    """ln(b_j(o_t)) of one frame for the given states only, other parameter types evaluate every state"""
+    if isinstance(parameters, StateParameters):
+        squared_error = (observation - parameters.means[indices]) ** 2 * parameters.inverse_variances[indices]
+        if squared_error.ndim == 2: # diagonal covariance, dimensions sum
+            squared_error = np.sum(squared_error, axis=1)
+        return parameters.log_normalisers[indices] - 0.5 * squared_error
+
+    return parameters.log_emission(observation[np.newaxis])[indices, 0]
+
+
+def prune(scores, beam: float = None, top_k: int = None):
+    """Positions of the scores (log domain) to keep, within beam of the best and/or the top_k, sorted"""
+    keep = np.flatnonzero(np.isfinite(scores))
+    if beam is not None:
+        keep = keep[scores[keep] >= np.max(scores[keep], initial=-np.inf) - beam]
+    if top_k is not None and len(keep) > top_k:
+        keep = np.sort(keep[np.argpartition(scores[keep], -top_k)[-top_k:]])
+    return keep
+
+
+def band_targets(transitions, active):
+    """A x K destination of every diagonal from the active states, and which of those stay in the model"""
+    targets = active[:, np.newaxis] + transitions.offsets
+    return targets, (targets >= 0) & (targets < transitions.state_count)
+
+
+def successor_values(transitions, active, values, length):
+    """sum_i( values_i * a_ij ) over active states i only, length N
+
+    dense models multiply just the active rows of a_ij, banded ones only follow the active diagonals
+    """
+    if isinstance(transitions, DenseTransitions):
+        return values @ transitions.matrix[active]
+
+    targets, inside = band_targets(transitions, active)
+    weights = values[:, np.newaxis] * transitions.bands[active]
+    return np.bincount(targets[inside], weights=weights[inside], minlength=length)
+
+
+def successor_max(transitions, active, log_values, length):
+    """(max_i( log_values_i + ln(a_ij) ), best i) over active states i only, length N"""
+    if isinstance(transitions, DenseTransitions):
+        candidates = log_values[:, np.newaxis] + transitions.log_matrix[active]
+        best = np.argmax(candidates, axis=0)
+        return candidates[best, np.arange(length)], active[best]
+
+    targets, inside = band_targets(transitions, active)
+    candidates = (log_values[:, np.newaxis] + transitions.log_bands[active])[inside]
+    sources = np.broadcast_to(active[:, np.newaxis], targets.shape)[inside]
+    targets = targets[inside]
+
+    best = np.full(length, -np.inf)
+    np.maximum.at(best, targets, candidates)
+    best_from = np.zeros(length, dtype=int)
+    winners = candidates == best[targets] # ties go to whichever is written last
+    best_from[targets[winners]] = sources[winners]
+    return best, best_from
+
+
+def beam_forward(states, observations, state_transitions, beam: float = None, top_k: int = None):
+    """Scaled forward pass that only carries states within beam (natural log) of the best, and/or the top_k
+
+    each frame only the active states' successors are expanded and only their emissions evaluated.
+    With neither limit it's the full forward pass, returns a BeamResult without a path
+    """
+    parameters = as_state_parameters(states)
+    transitions = as_transitions(state_transitions)
+    observations = np.asarray(observations, dtype=float)
+    length = len(parameters)
+    active_counts = np.zeros(len(observations), dtype=int)
+    if len(observations) == 0:
+        return BeamResult(log_likelihood=-np.inf, active_counts=active_counts)
+
+    active = alpha = None # set by frame 0, which starts from the entry probs instead
+    with np.errstate(divide='ignore'):
+        log_likelihood = 0.
+        for t, observation in enumerate(observations):
+            column = transitions.entry if t == 0 else successor_values(transitions, active, alpha, length)
+            candidates = np.flatnonzero(column)
+
+            log_column = np.log(column[candidates]) + candidate_log_emission(parameters, observation, candidates)
+            keep = prune(log_column, beam=beam, top_k=top_k)
+            active = candidates[keep]
+            if len(active) == 0:
+                return BeamResult(log_likelihood=-np.inf, active_counts=active_counts)
+
+            # normalised from the best state so the exp can't underflow everything
+            shift = np.max(log_column[keep])
+            alpha = np.exp(log_column[keep] - shift)
+            scale = np.sum(alpha)
+            alpha /= scale
+            log_likelihood += shift + np.log(scale)
+            active_counts[t] = len(active)
+
+        log_likelihood += np.log(alpha @ transitions.exit[active])
+
+    return BeamResult(log_likelihood=log_likelihood, active_counts=active_counts)
+
+
+def beam_viterbi(states, observations, state_transitions, beam: float = None, top_k: int = None,
+                 path: bool = True):
+    """Viterbi decoding over the active states only, see beam_forward() for the pruning
+
+    backpointers are kept per frame for the surviving states only, with neither limit it's viterbi()
+    """
+    parameters = as_state_parameters(states)
+    transitions = as_transitions(state_transitions)
+    observations = np.asarray(observations, dtype=float)
+    length = len(parameters)
+    active_counts = np.zeros(len(observations), dtype=int)
+    no_path = np.zeros(0, dtype=backpointer_dtype(length)) if path else None
+    if len(observations) == 0:
+        return BeamResult(log_likelihood=-np.inf, active_counts=active_counts, path=no_path)
+
+    history = [] # (active states, best previous state for each) per frame
+    active = delta = None # set by frame 0, which starts from the entry probs instead
+    with np.errstate(divide='ignore'):
+        for t, observation in enumerate(observations):
+            if t == 0:
+                scores, best_from = np.log(transitions.entry), None
+            else:
+                scores, best_from = successor_max(transitions, active, delta, length)
+            candidates = np.flatnonzero(np.isfinite(scores))
+
+            log_column = scores[candidates] + candidate_log_emission(parameters, observation, candidates)
+            keep = prune(log_column, beam=beam, top_k=top_k)
+            active = candidates[keep]
+            if len(active) == 0:
+                return BeamResult(log_likelihood=-np.inf, active_counts=active_counts, path=no_path)
+
+            delta = log_column[keep]
+            active_counts[t] = len(active)
+            if path:
+                history.append((active, None if best_from is None else best_from[active]))
+
+        final = delta + np.log(transitions.exit[active])
+
+    best = int(np.argmax(final))
+    if not path:
+        return BeamResult(log_likelihood=final[best], active_counts=active_counts)
+
+    # walk back through each frame's survivors, active states are sorted so searchsorted finds them
+    best_path = np.empty(len(observations), dtype=backpointer_dtype(length))
+    best_path[-1] = active[best]
+    for t in range(len(observations) - 1, 0, -1):
+        frame_active, frame_from = history[t]
+        best_path[t - 1] = frame_from[np.searchsorted(frame_active, best_path[t])]
+
+    return BeamResult(log_likelihood=final[best], active_counts=active_counts, path=best_path)
@@ -0,0 +1,285 @@
+import argparse
+import json
+import platform
+import sys
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+
+from batch import BatchMarkovModel
+from constants import state1, state2, observations, state_transition
+from markov import MarkovModel
+from markovlog import LogMarkovModel
+from parameters import StateParameters
+from training import fit
+
+# constants.py fixture, P(O|model) and one Baum-Welch M-step from the linear model
+FIXTURE_REFERENCE = {
+    'p_obs': 1.9197737567283167e-10,
+    'mean': [1.6747846620246418, 4.089148442531048],
+    'variance': [1.8465047320872243, 0.37804421554121403],
+    'state_transitions': [[0.8035063977185256, 0.18507025074035827],
+                          [0.26043108861282116, 0.49589971079165435]],
+}
+FIXTURE_TOLERANCE = 1e-9  # relative
+PRECISION_TOLERANCE = 1e-4  # relative, float32 lattices against float64
+
+MODEL_PHASES = ('emission', 'populate_forward', 'populate_backward', 'populate_occupation',
+                'reestimated_mean', 'reestimated_variance', 'reestimated_state_transitions')
+
+
+####################################
+#            Workloads
+####################################
+
+def random_model(state_count: int, rng):
+    """Well separated gaussian states with a random left-to-right biased padded transition matrix"""
+    parameters = StateParameters(means=np.linspace(-2. * state_count, 2. * state_count, state_count),
+                                 variances=rng.uniform(0.5, 2., state_count))
+
+    state_transitions = np.zeros((state_count + 2, state_count + 2))
+    state_transitions[0, 1:state_count + 1] = rng.dirichlet(np.ones(state_count))
+    inner = rng.uniform(0.01, 0.1, (state_count, state_count)) + 4. * np.eye(state_count)
+    inner = np.hstack([inner, rng.uniform(0.01, 0.1, (state_count, 1))])  # exit column
+    state_transitions[1:state_count + 1, 1:] = inner / np.sum(inner, axis=1, keepdims=True)
+
+    return parameters, state_transitions
+
+
+def random_sequence(parameters: StateParameters, length: int, rng):
+    """Observations drawn from randomly chosen states, a plausible but not exact fit"""
+    chosen = rng.integers(len(parameters), size=length)
+    return rng.normal(parameters.means[chosen], parameters.std_devs[chosen])
+
+
+def mismatched_model(state_count: int, dimensions: int, rng):
+    """Tight diagonal covariance states near the origin, random_model()'s transitions
+
+    frames drawn from N(0, 3) sit far from every state, their densities underflow float32 outright
+    """
+    _, state_transitions = random_model(state_count, rng)
+    parameters = StateParameters(means=rng.normal(0., 1., (state_count, dimensions)),
+                                 variances=rng.uniform(0.05, 0.2, (state_count, dimensions)))
+    return parameters, state_transitions
+
+
+def measure(function, repeats: int):
+    """(best of repeats seconds, peak traced bytes of one extra run), timing runs aren't traced"""
+    timings = []
+    for _ in range(repeats):
+        start = perf_counter()
+        function()
+        timings.append(perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(timings), peak
+
+
+####################################
+#            Benchmarks
+####################################
+
+def check_fixture():
+    """Every engine against the reference values for the constants.py fixture, returns max relative errors"""
+
+    def relative_error(value, reference):
+        reference = np.asarray(reference, dtype=float)
+        return float(np.max(np.abs(np.asarray(value) - reference) / np.abs(reference)))
+
+    states = [state1, state2]
+    linear = MarkovModel(states, observations, state_transition).populate()
+    scaled = MarkovModel(states, observations, state_transition).populate(scaled=True)
+    log = LogMarkovModel(states, observations, state_transition).populate()
+    batch = BatchMarkovModel(states, [observations], state_transition).populate()
+
+    errors = {
+        'linear_p_obs': relative_error(linear.observation_likelihood, FIXTURE_REFERENCE['p_obs']),
+        'scaled_p_obs': relative_error(np.exp(scaled.observation_likelihood), FIXTURE_REFERENCE['p_obs']),
+        'log_p_obs': relative_error(np.exp(log.observation_likelihood), FIXTURE_REFERENCE['p_obs']),
+        'batch_p_obs': relative_error(np.exp(batch.observation_likelihood), FIXTURE_REFERENCE['p_obs']),
+    }
+    for name, model in (('linear', linear), ('scaled', scaled), ('log', log)):
+        errors[name + '_mean'] = relative_error(model.reestimated_mean(), FIXTURE_REFERENCE['mean'])
+        errors[name + '_variance'] = relative_error(model.reestimated_variance(), FIXTURE_REFERENCE['variance'])
+        errors[name + '_state_transitions'] = relative_error(model.reestimated_state_transitions(),
+                                                             FIXTURE_REFERENCE['state_transitions'])
+
+    mean, variance, padded = batch.reestimate()
+    errors['batch_mean'] = relative_error(mean, FIXTURE_REFERENCE['mean'])
+    errors['batch_variance'] = relative_error(variance, FIXTURE_REFERENCE['variance'])
+    errors['batch_state_transitions'] = relative_error(padded[1:3, 1:3], FIXTURE_REFERENCE['state_transitions'])
+
+    return errors
+
+
+def check_precision(state_count: int = 16, length: int = 2000, batch_size: int = 8, seed: int = 0):
+    """float32 lattices against float64 on a random workload, returns max relative errors
+
+    covers the scaled, log and batch engines: ln(P(O|model)) and the re-estimated means, variances
+    and transitions (which are all accumulated in float64 either way), on the random workload and on
+    a mismatched 13 dimensional one (mismatched_model()). Typical at the defaults: ~1e-8 log
+    likelihood and ~1e-5 re-estimates for every engine (~1e-4 for the log engine's mismatched means),
+    a nan error means an engine broke down
+    """
+    rng = np.random.default_rng(seed)
+    parameters, state_transitions = random_model(state_count, rng)
+    workloads = {'': (parameters, state_transitions,
+                      [random_sequence(parameters, length, rng) for _ in range(batch_size)])}
+    parameters, state_transitions = mismatched_model(8, 13, rng)
+    workloads['mismatched_'] = (parameters, state_transitions,
+                                [rng.normal(0., 3., (length // 10, 13)) for _ in range(batch_size)])
+
+    def relative_error(value, reference):
+        return float(np.max(np.abs(np.asarray(value) - reference) / np.maximum(np.abs(reference), 1e-12)))
+
+    errors = {}
+    for prefix, (parameters, state_transitions, sequences) in workloads.items():
+        engines = {
+            'scaled': lambda dtype: MarkovModel(parameters, sequences[0], state_transitions, dtype=dtype).populate(scaled=True),
+            'log': lambda dtype: LogMarkovModel(parameters, sequences[0], state_transitions, dtype=dtype).populate(),
+            'batch': lambda dtype: BatchMarkovModel(parameters, sequences, state_transitions, dtype=dtype).populate(),
+        }
+        for name, build in engines.items():
+            name = prefix + name
+            single, double = build(np.float32), build(np.float64)
+            errors[name + '_log_likelihood'] = relative_error(single.observation_likelihood, double.observation_likelihood)
+
+            single, double = single.accumulate(), double.accumulate()
+            errors[name + '_mean'] = relative_error(single.reestimated_mean(), double.reestimated_mean())
+            errors[name + '_variance'] = relative_error(single.reestimated_variance(), double.reestimated_variance())
+            errors[name + '_state_transitions'] = relative_error(single.reestimated_state_transitions(),
+                                                                 double.reestimated_state_transitions())
+    return errors
+
+
+def benchmark_model(state_count: int, length: int, repeats: int, rng):
+    """Time each MarkovModel phase on one scaled sequence, the forward pass is what the others read"""
+    parameters, state_transitions = random_model(state_count, rng)
+    sequence = random_sequence(parameters, length, rng)
+
+    # everything cached up front, each phase below is then rebuilt in place on its own
+    model = MarkovModel(parameters, sequence, state_transitions).populate(scaled=True)
+
+    phases = {
+        'emission': lambda: model.evaluate_emission(out=model._emission),
+        'populate_forward': model.populate_forward,
+        'populate_backward': model.populate_backward,
+        'populate_occupation': model.populate_occupation,
+        'reestimated_mean': model.reestimated_mean,
+        'reestimated_variance': model.reestimated_variance,
+        'reestimated_state_transitions': model.reestimated_state_transitions,
+    }
+
+    results = []
+    for phase in MODEL_PHASES:
+        seconds, peak = measure(phases[phase], repeats)
+        results.append({'benchmark': phase, 'states': state_count, 'frames': length, 'batch': 1,
+                        'seconds': seconds, 'peak_bytes': peak})
+    return results
+
+
+def benchmark_training(state_count: int, length: int, batch_size: int, iterations: int, rng):
+    """Full fit() iterations over a batch of sequences, seconds per iteration"""
+    parameters, state_transitions = random_model(state_count, rng)
+    sequences = [random_sequence(parameters, length, rng) for _ in range(batch_size)]
+
+    # tolerance never met so every run does the same number of iterations
+    start = perf_counter()
+    result = fit(parameters, sequences, state_transitions, max_iterations=iterations, tolerance=-np.inf)
+    seconds = (perf_counter() - start) / result.trace.iterations
+
+    tracemalloc.start()
+    fit(parameters, sequences, state_transitions, max_iterations=1, tolerance=-np.inf)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'benchmark': 'training_iteration', 'states': state_count, 'frames': length, 'batch': batch_size,
+            'seconds': seconds, 'peak_bytes': peak,
+            'log_likelihood': float(result.trace.log_likelihood[-1])}
+
+
+####################################
+#           Comparison
+####################################
+
+def result_key(result: dict):
+    return result['benchmark'], result['states'], result['frames'], result['batch']
+
+
+def compare(results: list, baseline: list, threshold: float):
+    """Print time ratios against a saved run, returns keys slower than threshold x baseline"""
+    baseline = {result_key(result): result for result in baseline}
+
+    regressions = []
+    for result in results:
+        previous = baseline.get(result_key(result))
+        if previous is None:
+            continue
+        ratio = result['seconds'] / previous['seconds']
+        flag = ' REGRESSION' if ratio > threshold else ''
+        print('{:30} N={:<5} T={:<7} B={:<4} {:6.2f}x{}'.format(*result_key(result), ratio, flag))
+        if ratio > threshold:
+            regressions.append(result_key(result))
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Time and memory benchmarks for the markov model engines')
+    parser.add_argument('--states', type=int, nargs='+', default=[2, 8, 32, 128])
+    parser.add_argument('--lengths', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16])
+    parser.add_argument('--iterations', type=int, default=5, help='training iterations per measurement')
+    parser.add_argument('--repeats', type=int, default=3, help='best of repeats for each phase')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='earlier --output to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio reported as a regression')
+    args = parser.parse_args(arguments)
+
+    rng = np.random.default_rng(args.seed)
+
+    fixture = check_fixture()
+    fixture_ok = max(fixture.values()) < FIXTURE_TOLERANCE
+    print('fixture agreement', 'ok' if fixture_ok else 'FAILED', '(max relative error {:.2e})'.format(max(fixture.values())))
+
+    precision = check_precision(seed=args.seed)
+    precision_ok = max(precision.values()) < PRECISION_TOLERANCE
+    print('float32 agreement', 'ok' if precision_ok else 'FAILED', '(max relative error {:.2e})'.format(max(precision.values())))
+
+    results = []
+    for state_count in args.states:
+        for length in args.lengths:
+            results.extend(benchmark_model(state_count, length, args.repeats, rng))
+            for batch_size in args.batch_sizes:
+                results.append(benchmark_training(state_count, length, batch_size, args.iterations, rng))
+
+    for result in results:
+        print('{:30} N={:<5} T={:<7} B={:<4} {:10.6f}s {:12,d} bytes'.format(*result_key(result), result['seconds'],
+                                                                           result['peak_bytes']))
+
+    report = {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'platform': platform.platform(), 'processor': platform.processor()},
+        'arguments': vars(args),
+        'fixture': fixture,
+        'precision': precision,
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)['results'], args.threshold)
+
+    return 0 if fixture_ok and precision_ok and not regressions else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
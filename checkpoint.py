@@ -0,0 +1,126 @@
+from math import ceil, sqrt
+
+import numpy as np
+
+from baumwelch import BaumWelchStatistics
+from parameters import as_state_parameters
+from topology import as_transitions
+
+
+def checkpointed_statistics(states: list, observations: list, state_transitions: np.ndarray, interval: int = None):
+    """Baum-Welch statistics for one long sequence without holding N x T forward/backward/occupation lattices
+
+    Scaled forward columns are kept only every interval frames (default ~sqrt(T)), the backward sweep
+    recomputes each segment's forward columns from its checkpoint and streams occupation/transition
+    likelihoods straight into the accumulators. Memory is O(N * sqrt(T)) plus the T normalisers,
+    returns (statistics, ln(P(O|model))). An empty sequence has no statistics, raises ValueError
+    """
+
+    observations = np.asarray(observations, dtype=float)
+    topology = as_transitions(state_transitions)
+    length = len(states)
+    frames = len(observations)
+    if frames == 0:
+        raise ValueError('checkpointed_statistics needs at least one observation')
+    if interval is None:
+        interval = max(int(ceil(sqrt(frames))), 1)
+
+    parameters = as_state_parameters(states)
+    pi = topology.entry
+    eta = topology.exit
+
+    def segment_emission(start, stop):
+        """stop - start x N output densities, only ever one segment at a time"""
+        return parameters.emission(observations[start:stop], state_axis=-1)
+
+    def forward_segment(start, stop, column, emission, out=None):
+        """Scaled forward columns start .. stop - 1 continuing from column (alpha at start - 1, None at t = 0)"""
+        for t in range(start, stop):
+            if column is None:
+                column = pi * emission[t - start]
+            else:
+                column = topology.forward(column) * emission[t - start]
+            scale[t] = np.sum(column)
+            column = column / scale[t]
+            if out is not None:
+                out[t - start] = column
+        return column
+
+    ####################################
+    #  Forward, checkpoints + scales
+    ####################################
+
+    scale = np.zeros(frames)
+    starts = list(range(0, frames, interval))
+    checkpoints = np.zeros((len(starts), length)) # alpha at the frame before each segment, unused for the first
+
+    column = None
+    for segment, start in enumerate(starts):
+        if column is not None:
+            checkpoints[segment] = column
+        stop = min(start + interval, frames)
+        column = forward_segment(start, stop, column, segment_emission(start, stop))
+
+    exit_scale = column @ eta
+    log_likelihood = np.sum(np.log(scale)) + np.log(exit_scale)
+
+    ####################################
+    #   Backward, segment at a time
+    ####################################
+
+    occupation_sum = np.zeros(length)
+    emission_statistics = {} # weighted sums from parameters.weighted_statistics()
+    transitions = 0. # summed in the topology's layout, N x N or banded
+    entry = np.zeros(length)
+    exit = np.zeros(length)
+
+    forward = np.zeros((interval, length)) # reused segment buffers
+    backward = np.zeros((interval, length))
+
+    beta_next = None # beta at the first frame of the following segment
+    emission_next = None # b(o) at that frame
+    for segment in range(len(starts) - 1, -1, -1):
+        start = starts[segment]
+        stop = min(start + interval, frames)
+        span = stop - start
+        emission = segment_emission(start, stop)
+
+        # recompute this segment's forward columns from its checkpoint (rewrites identical scales)
+        previous = checkpoints[segment] if segment > 0 else None
+        forward_segment(start, stop, previous, emission, out=forward)
+
+        for t in range(stop - 1, start - 1, -1):
+            local = t - start
+            if t == frames - 1:
+                backward[local] = eta / exit_scale
+            elif local == span - 1:
+                backward[local] = topology.backward(emission_next * beta_next) / scale[t + 1]
+            else:
+                backward[local] = topology.backward(emission[local + 1] * backward[local + 1]) / scale[t + 1]
+
+        occupation = forward[:span] * backward[:span]
+        occupation_sum += np.sum(occupation, axis=0)
+        for name, value in parameters.weighted_statistics(occupation, observations[start:stop]).items():
+            emission_statistics[name] = emission_statistics.get(name, 0.) + value
+        if segment == 0:
+            entry += occupation[0]
+        if stop == frames:
+            exit += occupation[-1]
+
+        # transitions inside the segment, alpha(t-1) * a * b(o_t) * beta(t) / c_t
+        weighted_backward = emission[1:span] * backward[1:span] / scale[start + 1:stop, np.newaxis]
+        transitions = transitions + topology.transition_sums(forward[:span - 1], weighted_backward)
+        # and across the boundary into the following segment
+        if beta_next is not None:
+            transitions = transitions + topology.transition_sums(forward[span - 1:span],
+                                                                 (emission_next * beta_next / scale[stop])[np.newaxis])
+
+        beta_next = backward[0].copy()
+        emission_next = emission[0]
+
+    statistics = BaumWelchStatistics(occupation=occupation_sum,
+                                     transitions=transitions,
+                                     entry=entry,
+                                     exit=exit,
+                                     **emission_statistics)
+    return statistics, log_likelihood
@@ -0,0 +1,217 @@
+import json
+import os
+from queue import Full, Queue
+from threading import Event, Thread
+
+import numpy as np
+
+from batch import BatchMarkovModel, pad_sequences
+from parameters import as_state_parameters
+from training import baum_welch
+
+# A corpus is a directory:
+#   corpus.json   dtype, feature shape and total frame count
+#   data.bin      every sequence's frames back to back, raw and headerless so it can be appended to
+#   index.npy     S x 2 (offset, length) in frames
+
+
+class CorpusWriter:
+    """Append observation sequences to a new on-disk corpus one at a time, nothing is held in memory
+
+    use as a context manager or call close() to write the index
+    """
+
+    def __init__(self, path: str, feature_shape: tuple = (), dtype=float):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.feature_shape = tuple(feature_shape)
+        self.dtype = np.dtype(dtype)
+
+        self.data = open(os.path.join(path, 'data.bin'), 'wb')
+        self.index = []
+        self.frames = 0
+
+    def append(self, sequence):
+        sequence = np.ascontiguousarray(sequence, dtype=self.dtype)
+        if len(sequence) == 0:
+            raise ValueError('sequence {} has no observations, empty sequences are not supported'.format(len(self.index)))
+        if sequence.shape[1:] != self.feature_shape:
+            raise ValueError('sequence frames are {}, corpus expects {}'.format(sequence.shape[1:], self.feature_shape))
+
+        self.data.write(sequence.tobytes())
+        self.index.append((self.frames, len(sequence)))
+        self.frames += len(sequence)
+
+    def close(self):
+        self.data.close()
+        np.save(os.path.join(self.path, 'index.npy'), np.array(self.index, dtype=np.int64).reshape(-1, 2))
+        with open(os.path.join(self.path, 'corpus.json'), 'w') as file:
+            json.dump({'dtype': self.dtype.str, 'feature_shape': list(self.feature_shape), 'frames': self.frames}, file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_corpus(path: str, sequences, feature_shape: tuple = (), dtype=float):
+    """Write any iterable of sequences (a generator is fine) as a corpus"""
+    with CorpusWriter(path, feature_shape=feature_shape, dtype=dtype) as writer:
+        for sequence in sequences:
+            writer.append(sequence)
+
+
+class Corpus:
+    """Read only, memory-mapped observation sequences, indexing returns zero-copy views into the file
+
+    nothing is read from disk until a view's frames are actually touched
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'corpus.json')) as file:
+            header = json.load(file)
+
+        self.feature_shape = tuple(header['feature_shape'])
+        self.index = np.load(os.path.join(path, 'index.npy'))
+        shape = (header['frames'],) + self.feature_shape
+        self.data = np.memmap(os.path.join(path, 'data.bin'), dtype=np.dtype(header['dtype']), mode='r', shape=shape) \
+            if header['frames'] else np.zeros(shape, dtype=np.dtype(header['dtype']))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, index: int):
+        offset, length = self.index[index]
+        return self.data[offset:offset + length]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    @property
+    def lengths(self):
+        return self.index[:, 1]
+
+    def batches(self, batch_size: int, order=None):
+        """Lists of up to batch_size views, in order (an index array, e.g. sorted by length) or file order"""
+        order = np.arange(len(self)) if order is None else np.asarray(order)
+        for start in range(0, len(order), batch_size):
+            yield [self[index] for index in order[start:start + batch_size]]
+
+
+####################################
+#            Prefetching
+####################################
+
+def prefetch(iterable, depth: int = 2, transform=None, timeout: float = 0.1):
+    """Run an iterable (and transform on each item) in a background thread, up to depth items ahead
+
+    the producer thread pages data in from disk (numpy copies drop the GIL) while the consumer
+    computes, exceptions in the producer are re-raised on the consumer side. If the consumer stops
+    early (closed, or raised) the producer notices within timeout seconds and exits, dropping its items
+    """
+    queue = Queue(maxsize=depth)
+    stop = Event()
+    finished = object()
+
+    def put(item):
+        # blocks while the queue is full, gives up once the consumer has gone
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=timeout)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(transform(item) if transform is not None else item):
+                    return
+        except BaseException as error:
+            put(error)
+            return
+        put(finished)
+
+    Thread(target=produce, daemon=True).start()
+
+    try:
+        while True:
+            item = queue.get()
+            if item is finished:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def padded_batches(corpus: Corpus, batch_size: int, depth: int = 2, order=None):
+    """Prefetched (B x T_max (x D) padded array, lengths) batches ready for BatchMarkovModel"""
+    if order is None: # similar lengths together waste fewer padded frames
+        order = np.argsort(corpus.lengths, kind='stable')
+    return prefetch(corpus.batches(batch_size, order=order), depth=depth, transform=pad_sequences)
+
+
+####################################
+#       Scoring and Training
+####################################
+
+def score_corpus(states, corpus: Corpus, state_transitions, batch_size: int = 64, depth: int = 2):
+    """ln(P(O|model)) for every sequence in the corpus, forward passes only, in corpus order"""
+    order = np.argsort(corpus.lengths, kind='stable')
+    log_likelihood = np.zeros(len(corpus))
+
+    model = None
+    start = 0
+    for observations, lengths in padded_batches(corpus, batch_size, depth=depth, order=order):
+        if model is None:
+            model = BatchMarkovModel(states, observations, state_transitions, lengths=lengths)
+        else:
+            model.set_sequences(observations, lengths=lengths)
+        model.populate_forward()
+
+        log_likelihood[order[start:start + len(lengths)]] = model.log_likelihood
+        start += len(lengths)
+
+    return log_likelihood
+
+
+def corpus_expectation(corpus: Corpus, batch_size: int = 64, depth: int = 2):
+    """baum_welch() E-step streaming the corpus through one BatchMarkovModel a batch at a time"""
+    model = None
+
+    def expectation(parameters, state_transitions):
+        nonlocal model
+        statistics = None
+        log_likelihood = 0.
+
+        for observations, lengths in padded_batches(corpus, batch_size, depth=depth):
+            if model is None:
+                model = BatchMarkovModel(parameters, observations, state_transitions, lengths=lengths)
+            else:
+                model.states = parameters
+                model.state_transitions = state_transitions
+                model.set_sequences(observations, lengths=lengths)
+            model.populate()
+
+            batch_statistics = model.accumulate()
+            statistics = batch_statistics if statistics is None else statistics + batch_statistics
+            log_likelihood += model.observation_likelihood
+
+        return statistics, log_likelihood
+
+    return expectation
+
+
+def fit_corpus(states, corpus: Corpus, state_transitions, batch_size: int = 64, depth: int = 2,
+               max_iterations: int = 50, tolerance: float = 1e-4, time_budget: float = None,
+               callback=None, profiler=None):
+    """Baum-Welch over a corpus too big for memory, only batch_size sequences are resident at once"""
+    return baum_welch(corpus_expectation(corpus, batch_size=batch_size, depth=depth),
+                      as_state_parameters(states), state_transitions,
+                      max_iterations=max_iterations, tolerance=tolerance,
+                      time_budget=time_budget, callback=callback, profiler=profiler)
@@ -1,51 +1,278 @@
 import numpy as np
 
-from maths import gaussian
+from baumwelch import BaumWelchStatistics
+from maths import shifted_exp
+from parameters import as_state_parameters
+from profiling import profiled
+from topology import as_transitions
 
 class MarkovModel:
-    """Describes a single training iteration including likelihoods and reestimation params"""
+    """Describes a single training iteration including likelihoods and reestimation params
+
+    Lattices and likelihoods are built on first access and cached, setting states, observations,
+    state_transitions or scaled drops whatever depended on them. Scoring through observation_likelihood
+    only ever runs the forward pass
+
+    dtype=np.float32 halves lattice/emission memory and runs the recursions in single precision,
+    use it scaled or in the log domain (unscaled float32 underflows after a few dozen frames).
+    Emissions are evaluated in float64 and stored relative to each frame's largest density (scaled or
+    log), those per-frame shifts, ln(P(O|model)) and every re-estimation sum are kept in float64.
+    Against float64 (benchmark.py check_precision) scaled and log models agree to ~1e-8 relative in
+    ln(P(O|model)) and ~1e-5 in re-estimates, far off frames included
+    """
+
+    # cached artefact -> method that builds it, each may read the others through their properties.
+    # Read artefacts through their properties, calling a builder directly rebuilds without caching
+    builders = {
+        'forward': 'populate_forward',
+        'p_obs_forward': 'calculate_p_obs_forward',
+        'backward': 'populate_backward',
+        'p_obs_backward': 'calculate_p_obs_backward',
+        'occupation': 'populate_occupation',
+        'emission_statistics': 'calculate_emission_statistics',
+    }
+    lattices = ('forward', 'p_obs_forward', 'backward', 'p_obs_backward', 'occupation') # what populate() builds
+
+    def __init__(self, states: list, observations: list = list(), state_transitions: list = list(),
+                 profiler=None, dtype=float):
+        self.profiler = profiler # profiling.Profiler, None keeps instrumentation off
+        self.dtype = np.dtype(dtype) # lattice/emission precision
+        self._valid = set() # artefacts in builders currently cached
+        self._scaled = False
 
-    def __init__(self, states: list, observations: list = list(), state_transitions: list = list()):
         self.observations = observations
         self.state_transitions = state_transitions
-        # ^ use state number not state index, is padded by entry and exit probs
+        # ^ use state number not state index, is padded by entry and exit probs (or BandedTransitions)
 
         self.states = states
 
-        self.forward = np.zeros((len(states), len(observations)))
-        self.p_obs_forward = 0
+        self._forward = None
+        self._p_obs_forward = 0
+        self._backward = None
+        self._p_obs_backward = 0
+        self._occupation = None
+        self._scale = None
+        # ^ per-frame forward normalisers c_t when scaled, final entry normalises the exit probs
+        self._emission_statistics = None
+        self.allocate_lattices()
+
+    def allocate_lattices(self):
+        """(Re)allocate N x T lattice buffers when the state count or sequence length changes"""
+        shape = (len(self.parameters), len(self.observations))
+        if self._forward is not None and self._forward.shape == shape:
+            return
+
+        self._forward = np.zeros(shape, dtype=self.dtype)
+        self._backward = np.zeros(shape, dtype=self.dtype)
+        self._occupation = np.zeros(shape, dtype=self.dtype)
+        self._scale = np.zeros(shape[1] + 1, dtype=self.dtype)
+
+        if self.profiler is not None:
+            self.profiler.allocated(self._forward, self._backward, self._occupation, self._scale)
+
+    def invalidate(self):
+        """Drop every cached lattice/likelihood, the emission cache is handled by the setters"""
+        self._valid.clear()
+
+    def dependencies(self, name: str):
+        """Artefacts (and 'emission') a builder reads, only scaled backward passes need the forward normalisers"""
+        return {
+            'forward': ('emission',),
+            'p_obs_forward': ('forward',),
+            'backward': ('emission', 'forward') if self.scaled else ('emission',),
+            'p_obs_backward': ('backward',),
+            'occupation': ('forward', 'backward', 'p_obs_forward'),
+            'emission_statistics': ('occupation',),
+        }[name]
+
+    def require(self, name: str):
+        """Build a cached artefact (see builders) unless it's still valid
+
+        dependencies are built first, outside this artefact's profiled phase, so phase times never overlap
+        """
+        if name not in self._valid:
+            for dependency in self.dependencies(name):
+                if dependency == 'emission':
+                    self.emission
+                else:
+                    self.require(dependency)
 
-        self.backward = np.zeros((len(states), len(observations)))
-        self.p_obs_backward = 0
+            with profiled(self.profiler, name):
+                getattr(self, self.builders[name])()
+            self._valid.add(name)
 
-        self.occupation = np.zeros((len(states), len(observations)))
+    @property
+    def states(self):
+        return self._states
+
+    @states.setter
+    def states(self, value):
+        """Set state parameters (State list or StateParameters), invalidates emission likelihoods and lattices"""
+        previous = getattr(self, 'parameters', None)
+        self._states = value
+        self.parameters = as_state_parameters(value)
+        if previous is not None and len(previous) != len(self.parameters):
+            self._emission = None # new state count, buffer reallocated
+        self._emission_valid = False
+        self.emission_cache = {}
+        self.invalidate()
+        if getattr(self, '_forward', None) is not None:
+            self.allocate_lattices()
 
-    def get_other_state_index(self, state_in):
-        """For when state changes, get other index for retrieving state transitions (FOR 0 INDEXING)"""
-        if state_in == 0:
-            return 1
-        elif state_in == 1:
-            return 0
-        else:
-            print(f"invalid state index provided, ({state_in})")
+    @property
+    def observations(self):
+        return self._observations
+
+    @observations.setter
+    def observations(self, value):
+        """Set observation sequence, invalidates emission likelihoods and lattices"""
+        self._observations = np.asarray(value, dtype=float)
+        self._emission = None # new shape, buffer reallocated
+        self._emission_valid = False
+        self.emission_cache = {}
+        self.invalidate()
+        if getattr(self, '_forward', None) is not None:
+            self.allocate_lattices()
+
+    @property
+    def state_transitions(self):
+        """Padded (N + 2) x (N + 2) state transitions, dense even when the topology is banded"""
+        return self.transitions.padded
+
+    @state_transitions.setter
+    def state_transitions(self, value):
+        """Set a padded matrix or a BandedTransitions, recursions only visit the topology's allowed arcs
+
+        invalidates the lattices, emission likelihoods are kept
+        """
+        self.transitions = as_transitions(value)
+        self.recursion_transitions = self.transitions.astype(self.dtype) # matches the lattices
+        self.invalidate()
+
+    @property
+    def scaled(self):
+        """Whether lattices are normalised per frame, likelihoods are then ln(P)"""
+        return self._scaled
+
+    @scaled.setter
+    def scaled(self, value):
+        if value != self._scaled:
+            self.invalidate()
+            self._emission_valid = False # scaled emissions are stored relative to each frame's max
+        self._scaled = value
+
+    ####################################
+    #        Cached Artefacts
+    ####################################
+
+    @property
+    def forward(self):
+        """N x T forward likelihoods alpha_j(t)"""
+        self.require('forward')
+        return self._forward
+
+    @property
+    def scale(self):
+        """T + 1 forward normalisers c_t (of the relative emissions), only meaningful when scaled"""
+        self.require('forward')
+        return self._scale
 
-    def get_other_state_number(self, state_in):
-        """For when state changes, get other number for retrieving state transitions (FOR 1 INDEXING)"""
-        return self.get_other_state_index(state_in - 1) + 1
+    @property
+    def p_obs_forward(self):
+        self.require('p_obs_forward')
+        return self._p_obs_forward
+
+    @property
+    def backward(self):
+        """N x T backward likelihoods beta_i(t)"""
+        self.require('backward')
+        return self._backward
+
+    @property
+    def p_obs_backward(self):
+        self.require('p_obs_backward')
+        return self._p_obs_backward
+
+    @property
+    def occupation(self):
+        """N x T occupation likelihoods L_j(t)"""
+        self.require('occupation')
+        return self._occupation
+
+    @property
+    def emission(self):
+        """N x T output probability densities b_j(o_t) for every state/time, built once and cached
+
+        rebuilt in place after the states change, the observations stay put between training iterations.
+        Scaled models divide each frame by its largest density, see evaluate_emission(). Anything the
+        parameters keep for re-estimation (mixture component densities) goes in emission_cache until
+        the next accumulate()
+        """
+        if not self._emission_valid:
+            allocating = self._emission is None
+            if allocating:
+                self._emission = np.empty((len(self.parameters), len(self.observations)), dtype=self.dtype)
+            self.emission_cache = {}
+            with profiled(self.profiler, 'emission'):
+                self._emission = self.evaluate_emission(out=self._emission)
+            self._emission_valid = True
+
+            if self.profiler is not None:
+                self.profiler.count('emission_evaluations', self._emission.size)
+                if allocating:
+                    self.profiler.allocated(self._emission)
+        return self._emission
+
+    def evaluate_emission(self, out=None):
+        """Output densities for every state/observation into out (overridden by log models)
+
+        scaled, frame t is stored as b_j(o_t) / max_j(b_j(o_t)) and _emission_shift[t] keeps the float64 ln
+        of that max, so a frame far from every state doesn't underflow to a zero column (nan normalisers).
+        The scale c_t absorbs the division, only ln(P(O|model)) adds the shifts back
+        """
+        if not self.scaled:
+            self._emission_shift = np.zeros(len(self.observations))
+            return self.parameters.emission(self.observations, out=out, cache=self.emission_cache)
+
+        log_emission = self.parameters.log_emission(self.observations, cache=self.emission_cache)
+        out, self._emission_shift = shifted_exp(log_emission, axis=0, out=out)
+        return out
 
-    def populate(self):
-        """Calculate all likelihoods and both P(O|model)'s"""
+    @property
+    def entry_probabilities(self):
+        """pi, first row of the padded state transitions"""
+        return self.transitions.entry
+
+    @property
+    def exit_probabilities(self):
+        """eta, last column of the padded state transitions"""
+        return self.transitions.exit
+
+    @property
+    def transition_matrix(self):
+        """a_ij, inner N x N block of the padded state transitions (row = from, column = to)"""
+        return self.transitions.matrix
 
-        self.populate_forward()
-        self.calculate_p_obs_forward()
-        self.populate_backward()
-        self.calculate_p_obs_backward()
-        self.populate_occupation()
+    def populate(self, scaled: bool = False):
+        """Calculate all likelihoods and both P(O|model)'s now rather than on first access
+
+        scaled normalises each forward column and reuses the coefficients going backwards so long 
+        sequences don't underflow, P(O|model)'s are then reported as ln(P(O|model)) = sum(ln(c_t)).
+        Always rebuilds, so also picks up parameters edited in place (a dense model's padded matrix,
+        a banded model's bands), the transitions' log and lower precision copies included
+        """
+
+        self.scaled = scaled
+        self.state_transitions = self.transitions.refreshed() # invalidates too
+        self.emission # built (and profiled) up front rather than inside the forward phase
+
+        for name in self.lattices:
+            self.require(name)
         return self
     
     @property
     def observation_likelihood(self):
-        """abstraction for getting P(O|model) for future calculations (occupation/transition)"""
+        """abstraction for getting P(O|model) for future calculations (occupation/transition), ln(P) when scaled"""
         return self.p_obs_forward
 
     ####################################
@@ -54,106 +281,91 @@ class MarkovModel:
     
     def populate_forward(self):
         """Populate forward likelihoods for all states/times"""
-        
-        for t, observation in enumerate(self.observations):
-            # iterate through observations (time)
-            
-            for state_index, state in enumerate(self.states):
-                # both states at each step
 
-                state_number = state_index + 1 
-                # ^ for easier reading (arrays 0-indexed, _number 1-indexed)
+        if len(self.observations) == 0:
+            return self._forward
 
-                if t == 0: # calcualte initial, 0 = first row = initial
-                    self.forward[state_index, t] = self.state_transitions[0, state_number] * gaussian(observation, state.mean, state.std_dev)
-                else:
-                    # each state for each time has two paths leading to it, 
-                    # the same state (this) and the other state (other)
+        # calculate initial, entry probs * emission
+        self._forward[:, 0] = self.entry_probabilities * self.emission[:, 0]
+        if self.scaled:
+            self._scale[0] = np.sum(self._forward[:, 0])
+            self._forward[:, 0] /= self._scale[0]
+
+        transitions = self.recursion_transitions
+        emission = self.emission
+        for t in range(1, len(self.observations)):
+            # iterate through observations (time)
+            # every path into each state at once, sum_i( alpha_i(t-1) * a_ij ) * b_j(o_t)
+            self._forward[:, t] = transitions.forward(self._forward[:, t - 1]) * emission[:, t]
 
-                    other_index = self.get_other_state_index(state_index)
-                    other_number = other_index + 1 # for 1 indexing
-                    
-                    # previous value * prob of changing from previous state to current
-                    this_to_this = self.forward[state_index, t - 1] * self.state_transitions[state_number, state_number]
-                    other_to_this = self.forward[other_index, t - 1] * self.state_transitions[other_number, state_number]
+            if self.scaled: # normalise column to sum to 1
+                self._scale[t] = np.sum(self._forward[:, t])
+                self._forward[:, t] /= self._scale[t]
 
-                    self.forward[state_index, t] = (this_to_this + other_to_this) * gaussian(observation, state.mean, state.std_dev)
+        if self.scaled: # exit probs normalised as a final frame
+            self._scale[-1] = self._forward[:, -1] @ self.exit_probabilities
 
-        return self.forward
+        return self._forward
 
     def calculate_p_obs_forward(self):
         """Calculate, store and return P(O|model) going forwards"""
 
-        sum = 0
-        for state_index, final_likelihood in enumerate(self.forward[:, -1]):       
-            sum += final_likelihood * self.state_transitions[state_index + 1, -1]
-            # get exit prob from state transitions ^
-
-        self.p_obs_forward = sum
-        return sum
+        if self.scaled:
+            # scaled forwards sum to 1, P(O|model) is the product of the normalisers (and emission shifts)
+            self._p_obs_forward = np.sum(np.log(self.scale), dtype=float) + np.sum(self._emission_shift)
+        else:
+            # final likelihoods weighted by exit probs from state transitions
+            self._p_obs_forward = self.forward[:, -1] @ self.exit_probabilities
+        return self._p_obs_forward
 
     def populate_backward(self):
         """Populate backward likelihoods for all states/times"""
 
+        if len(self.observations) == 0:
+            return self._backward
+
+        scale = self.scale if self.scaled else None # normalisers come from the forward pass
+
         # initialise with exit probabilities
-        self.backward[:, -1] = self.state_transitions[1:len(self.states) + 1, -1]
+        self._backward[:, -1] = self.exit_probabilities
+        if self.scaled:
+            self._backward[:, -1] /= scale[-1]
 
-        # below iterator skips first observation 
+        transitions = self.recursion_transitions
+        emission = self.emission
+        # iterate backwards through observations (time), skips first observation
         # (will be used when finalising P(O|model))
-        # iterate backwards through observations (time) [::-1] <- reverses list
-        for t, observation in list(enumerate(self.observations[1:]))[::-1]:
-            
-            # print(t, observation)
-            for state_index in range(len(self.states)):
-
-                state_number = state_index + 1 
-                # ^ for easier reading (arrays 0-indexed, _number 1-indexed)
-
-                other_index = self.get_other_state_index(state_index)
-                other_number = other_index + 1 # for 1 indexing
-
-                # observation for transitions from the same state
-                this_state_gaussian = gaussian(observation, self.states[state_index].mean, self.states[state_index].std_dev)
-                # observation for transitions from the other state
-                other_state_gaussian = gaussian(observation, self.states[other_index].mean, self.states[other_index].std_dev)
-                
-                # a * b * beta
-                this_from_this = self.state_transitions[state_number, state_number] * this_state_gaussian * self.backward[state_index, t + 1]
-                other_from_this = self.state_transitions[state_number, other_number] * other_state_gaussian * self.backward[other_index, t + 1]
-
-                self.backward[state_index, t] = this_from_this + other_from_this
-        
-        return self.backward
+        for t in range(len(self.observations) - 2, -1, -1):
+            # sum_j( a_ij * b_j(o_t+1) * beta_j(t+1) ) for every state i at once
+            self._backward[:, t] = transitions.backward(emission[:, t + 1] * self._backward[:, t + 1])
 
-    def calculate_p_obs_backward(self):
-        """Calculate, store and return P(O|model) going backwards"""
+            if self.scaled: # same normaliser as the forward column it pairs with
+                self._backward[:, t] /= scale[t + 1]
 
-        sum = 0
-        for state_index, initial_likelihood in enumerate(self.backward[:, 0]):
+        return self._backward
 
-            pi = self.state_transitions[0, state_index + 1]
-            b = gaussian(self.observations[0], 
-                         self.states[state_index].mean, 
-                         self.states[state_index].std_dev)
-            beta = initial_likelihood
+    def calculate_p_obs_backward(self):
+        """Calculate, store and return P(O|model) going backwards"""
 
-            sum +=  pi * b * beta
+        # pi * b * beta
+        self._p_obs_backward = np.sum(self.entry_probabilities 
+                                      * self.emission[:, 0] 
+                                      * self.backward[:, 0])
 
-        self.p_obs_backward = sum
-        return sum
+        if self.scaled: # backwards carry every normaliser after the first frame
+            self._p_obs_backward = (np.log(self._p_obs_backward) + np.sum(np.log(self.scale[1:]), dtype=float)
+                                    + np.sum(self._emission_shift))
+        return self._p_obs_backward
 
     def populate_occupation(self):
         """Populate occupation likelihoods for all states/times"""
 
-        for t in range(len(self.observations)): 
-            # iterate through observations (time)
-            
-            for state_index in range(len(self.states)):
-                
-                forward_backward = self.forward[state_index, t] * self.backward[state_index, t]
-                self.occupation[state_index, t] = forward_backward / self.observation_likelihood
-
-        return self.occupation
+        if self.scaled:
+            # scaled forward * backward is already normalised by P(O|model)
+            np.multiply(self.forward, self.backward, out=self._occupation)
+        else:
+            np.divide(self.forward * self.backward, self.observation_likelihood, out=self._occupation)
+        return self._occupation
 
     def transition_likelihood(self, from_index, to_index, t):
         """Get specific transition likelihood given state index either side and the timestep"""
@@ -162,76 +374,104 @@ class MarkovModel:
 
         if t == 0:
             print("no transition likelihood for t == 0")
+        if self.profiler is not None:
+            self.profiler.count('transition_likelihood')
 
         forward = self.forward[from_index, t - 1]
         transition = self.state_transitions[from_index + 1, to_index + 1]
-        emission = gaussian(self.observations[t], 
-                            self.states[to_index].mean, 
-                            self.states[to_index].std_dev)
+        emission = self.emission[to_index, t]
         backward = self.backward[to_index, t]
 
+        if self.scaled:
+            # forward/backward normalisers cover every frame but t
+            return (forward * transition * emission * backward) / self.scale[t]
         return (forward * transition * emission * backward) / self.observation_likelihood
 
+    def occupation_probabilities(self):
+        """Occupation likelihoods as plain probabilities for re-estimation (overridden by log models)"""
+        return self.occupation
+
+    def transition_sums(self):
+        """Transition likelihoods summed over t = 1 .. T - 1, sum_t( xi_ij(t) ) without a python loop
+
+        N x N for dense transitions, in the topology's band layout when banded
+        """
+
+        # beta_j(t) * b_j(o_t) / P(O|model) for every t >= 1
+        normaliser = self.scale[1:len(self.observations)] if self.scaled else self.observation_likelihood
+        weighted_backward = self.emission[:, 1:] * self.backward[:, 1:] / normaliser
+
+        # a_ij * sum_t( alpha_i(t-1) * b_j(o_t) * beta_j(t) ) / P(O|model), summed over t in float64
+        return self.transitions.transition_sums(np.asarray(self.forward[:, :-1].T, dtype=float),
+                                                np.asarray(weighted_backward.T, dtype=float))
+
     ####################################
     #     Baum-Welch Re-estimations
     ####################################
 
+    def accumulate(self):
+        """Collect Baum-Welch sufficient statistics for this sequence, can be summed over sequences"""
+        self.require('occupation') # lattices timed as their own phases, not inside this one
+        with profiled(self.profiler, 'accumulate'):
+            statistics = BaumWelchStatistics.from_posteriors(occupation=self.occupation_probabilities(),
+                                                             transition_sums=self.transition_sums(),
+                                                             observations=self.observations,
+                                                             parameters=self.parameters,
+                                                             cache=self.emission_cache)
+            self.emission_cache.clear() # E-step done, don't hold component densities past it
+            return statistics
+
+    def emission_statistics(self):
+        """Occupation weighted sums for the gaussian re-estimates only, skips the transition likelihoods
+
+        cached like the lattices, so per-state re-estimates index one set of sums
+        """
+        self.require('emission_statistics')
+        return self._emission_statistics
+
+    def calculate_emission_statistics(self):
+        self._emission_statistics = BaumWelchStatistics.from_posteriors(occupation=self.occupation_probabilities(),
+                                                                        transition_sums=None,
+                                                                        observations=self.observations,
+                                                                        parameters=self.parameters,
+                                                                        cache=self.emission_cache)
+        self.emission_cache.clear()
+        return self._emission_statistics
+
+    def reestimate(self):
+        """One Baum-Welch M-step, returns new means, variances and state transitions
+
+        transitions are padded for a dense model, a BandedTransitions with the same pattern when banded
+        """
+
+        statistics = self.accumulate()
+        return (statistics.reestimated_mean(), 
+                statistics.reestimated_variance(), 
+                self.transitions.reestimated(statistics))
+
     def reestimated_state_transitions(self):
         """Re-estimate state transitions using Baum-Welch training (Not on mark scheme)"""
 
-        length = len(self.states)
-        new_transitions = np.zeros((length, length))
-
-        # i
-        for from_index in range(length):
-            # j
-            for to_index in range(length):
-
-                # numerator iterates from t = 1 (when 0 indexing, 2 in the notes)
-                transition_sum = sum(self.transition_likelihood(from_index, to_index, t) 
-                                     for t in range(1, len(self.observations)))
-                occupation_sum = sum(self.occupation[from_index, t] 
-                                     for t in range(0, len(self.observations)))
-
-                new_transitions[from_index, to_index] = transition_sum / occupation_sum
-
-        return new_transitions
+        # numerator iterates from t = 1 (when 0 indexing, 2 in the notes), denominator over all t
+        occupation_sum = np.sum(self.occupation_probabilities(), axis=1)
+        return self.transitions.to_matrix(self.transition_sums()) / occupation_sum[:, np.newaxis]
 
     def reestimated_state_mean(self, state_index):
         """Re-estimate the gaussian mean for a state using occupation likelihoods, baum-welch"""
-        
-        numerator = 0 # sum over observations( occupation * observation )
-        denominator = 0 # sum over observations( occupation )
-        for t, observation in enumerate(self.observations): 
-            # iterate through observations (time)
-
-            occupation_likelihood = self.occupation[state_index, t]
-
-            numerator += occupation_likelihood * observation
-            denominator += occupation_likelihood
-
-        return numerator / denominator
+        return self.reestimated_mean()[state_index]
 
     def reestimated_mean(self):
         """Get all re-estimated gaussian means using occupation likelihoods"""
-        return [self.reestimated_state_mean(idx) for idx in range(len(self.states))]
 
+        # sum over observations( occupation * observation ) / sum over observations( occupation )
+        return self.emission_statistics().reestimated_mean()
 
     def reestimated_state_variance(self, state_index):
         """Re-estimate the gaussian variance for a state using occupation likelihoods, baum-welch"""
-        
-        numerator = 0 # sum over observations( occupation * (observation - mean)^2 )
-        denominator = 0 # sum over observations( occupation )
-        for t, observation in enumerate(self.observations): 
-            # iterate through observations (time)
-
-            occupation_likelihood = self.occupation[state_index, t]
-
-            numerator += occupation_likelihood * pow(observation - self.states[state_index].mean, 2)
-            denominator += occupation_likelihood
-
-        return numerator / denominator
+        return self.reestimated_variance()[state_index]
 
     def reestimated_variance(self):
         """Get all re-estimated gaussian variances using occupation likelihoods"""
-        return [self.reestimated_state_variance(idx) for idx in range(len(self.states))]
+
+        # sum over observations( occupation * (observation - mean)^2 ) / sum over observations( occupation )
+        return self.emission_statistics().reestimated_variance()
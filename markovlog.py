@@ -1,10 +1,187 @@
-from numpy import log as ln
+import numpy as np
+from numpy import log as ln, exp
 
-from maths import gaussian
+from maths import logsumexp, max_shift
 from markov import MarkovModel
 
 # child object to replace normal prob/likeli operations with log prob operations (normal prob for debugging)
 class LogMarkovModel(MarkovModel):
+    """MarkovModel evaluated in the log domain, forward/backward/occupation hold natural log likelihoods
+
+    Long sequences underflow to 0 in linear space, here the products become sums and the 
+    sums over paths become logsumexp's so P(O|model) stays representable for any length
+
+    The emissions and forward/backward lattices are stored relative to each frame's max, the per-frame
+    shifts are kept in float64 (like the scaled model's normalisers) so float32 lattices only hold the
+    small within-frame differences and re-estimate as precisely as the scaled engine
+    """
+
+    def allocate_lattices(self):
+        """MarkovModel lattices plus the T float64 forward/backward frame shifts"""
+        super().allocate_lattices()
+        if getattr(self, '_forward_shift', None) is None or len(self._forward_shift) != len(self.observations):
+            self._forward_shift = np.zeros(len(self.observations))
+            self._backward_shift = np.zeros(len(self.observations))
 
     def log_state_transitions(self):
-        self.state_transitions = ln(self.state_transitions)
\ No newline at end of file
+        """Natural log of the padded state transitions in the lattice precision, structural zeros become -inf"""
+        with np.errstate(divide='ignore'):
+            return ln(self.recursion_transitions.padded)
+
+    def log_entry(self):
+        """ln(pi) in the lattice precision"""
+        with np.errstate(divide='ignore'):
+            return ln(self.recursion_transitions.entry)
+
+    def log_exit(self):
+        """ln(eta) in the lattice precision"""
+        with np.errstate(divide='ignore'):
+            return ln(self.recursion_transitions.exit)
+
+    def evaluate_emission(self, out=None):
+        """N x T log output probability densities ln(b_j(o_t)), cached by MarkovModel.emission
+
+        each frame relative to its max, _emission_shift keeps those in float64 and the forward/backward
+        frame shifts take them in
+        """
+        log_emission = self.parameters.log_emission(self.observations, cache=self.emission_cache)
+        shift = max_shift(log_emission, axis=0)
+        self._emission_shift = shift[0]
+        return np.subtract(log_emission, shift, out=out)
+
+    ####################################
+    #         Log Likelihoods
+    ####################################
+
+    @property
+    def forward(self):
+        """N x T log forward likelihoods ln(alpha_j(t)), float64 (stored relative to the frame shifts)"""
+        self.require('forward')
+        return self._forward + self._forward_shift
+
+    @property
+    def backward(self):
+        """N x T log backward likelihoods ln(beta_i(t)), float64 (stored relative to the frame shifts)"""
+        self.require('backward')
+        return self._backward + self._backward_shift
+
+    def populate_forward(self):
+        """Populate log forward likelihoods for all states/times, each frame shifted by its max"""
+
+        if len(self.observations) == 0:
+            return self._forward
+
+        transitions = self.recursion_transitions
+        emission = self.emission
+
+        # ln(pi) + ln(b)
+        self._forward[:, 0] = self.log_entry() + emission[:, 0]
+        self.shift_frame(self._forward, self._forward_shift, 0, self._emission_shift[0])
+
+        for t in range(1, len(self.observations)):
+            # ln( sum_i( alpha_i(t-1) * a_ij ) ) + ln(b_j(o_t)) for every state j at once, allowed arcs only
+            self._forward[:, t] = transitions.log_forward(self._forward[:, t - 1]) + emission[:, t]
+            self.shift_frame(self._forward, self._forward_shift, t, self._forward_shift[t - 1] + self._emission_shift[t])
+
+        return self._forward
+
+    def calculate_p_obs_forward(self):
+        """Calculate, store and return ln(P(O|model)) going forwards"""
+
+        self.require('forward')
+        self._p_obs_forward = float(logsumexp(np.asarray(self._forward[:, -1], dtype=float) + self.log_exit())
+                                    + self._forward_shift[-1])
+        return self._p_obs_forward
+
+    def populate_backward(self):
+        """Populate log backward likelihoods for all states/times, each frame shifted by its max"""
+
+        if len(self.observations) == 0:
+            return self._backward
+
+        transitions = self.recursion_transitions
+        emission = self.emission
+
+        # initialise with exit probabilities
+        self._backward[:, -1] = self.log_exit()
+        self.shift_frame(self._backward, self._backward_shift, -1, 0.)
+
+        for t in range(len(self.observations) - 2, -1, -1):
+            # ln( sum_j( a_ij * b_j(o_t+1) * beta_j(t+1) ) ) for every state i at once, allowed arcs only
+            self._backward[:, t] = transitions.log_backward(emission[:, t + 1] + self._backward[:, t + 1])
+            self.shift_frame(self._backward, self._backward_shift, t, self._backward_shift[t + 1] + self._emission_shift[t + 1])
+
+        return self._backward
+
+    @staticmethod
+    def shift_frame(lattice, shifts, t: int, previous: float):
+        """Subtract frame t's max from the lattice column, shifts[t] accumulates it in float64"""
+        frame_max = np.max(lattice[:, t])
+        if not np.isfinite(frame_max): # impossible frame, nothing to shift
+            frame_max = 0.
+        lattice[:, t] -= frame_max
+        shifts[t] = previous + float(frame_max)
+
+    def calculate_p_obs_backward(self):
+        """Calculate, store and return ln(P(O|model)) going backwards"""
+
+        self.require('backward')
+        self._p_obs_backward = float(logsumexp(self.log_entry() + np.asarray(self.emission[:, 0] + self._backward[:, 0], dtype=float))
+                                     + self._backward_shift[0] + self._emission_shift[0])
+        return self._p_obs_backward
+
+    def populate_occupation(self):
+        """Populate log occupation likelihoods for all states/times"""
+
+        self.require('forward')
+        self.require('backward')
+        # small relative values in the lattice precision, large shifts in float64
+        frame_offset = self._forward_shift + self._backward_shift - self.observation_likelihood
+        self._occupation[...] = (self._forward + self._backward) + frame_offset
+        return self._occupation
+
+    def transition_likelihood(self, from_index, to_index, t):
+        """Get specific log transition likelihood given state index either side and the timestep"""
+
+        if t == 0:
+            print("no transition likelihood for t == 0")
+        if self.profiler is not None:
+            self.profiler.count('transition_likelihood')
+
+        with np.errstate(divide='ignore'):
+            transition = ln(self.state_transitions[from_index + 1, to_index + 1])
+
+        self.require('forward')
+        self.require('backward')
+        return (self._forward[from_index, t - 1] + self._forward_shift[t - 1]
+                + transition 
+                + self.emission[to_index, t] + self._emission_shift[t]
+                + self._backward[to_index, t] + self._backward_shift[t]
+                - self.observation_likelihood)
+
+    def log_transition_posteriors(self):
+        """(T - 1) x N x N log transition likelihoods, [t - 1, i, j] = ln(xi_ij(t)) for t = 1 .. T - 1"""
+
+        log_a = self.log_state_transitions()[1:len(self.states) + 1, 1:len(self.states) + 1]
+
+        # alpha_i(t-1) + a_ij + b_j(o_t) + beta_j(t) - P(O|model)
+        return (self.forward[:, :-1].T[:, :, np.newaxis] 
+                + log_a[np.newaxis, :, :] 
+                + (self.emission[:, 1:] + self._emission_shift[1:] + self.backward[:, 1:]).T[:, np.newaxis, :] 
+                - self.observation_likelihood)
+
+    def occupation_probabilities(self):
+        """Occupation likelihoods out of the log domain for re-estimation"""
+        return exp(self.occupation)
+
+    def transition_sums(self):
+        """Transition likelihoods summed over t = 1 .. T - 1, summed out of the log domain
+
+        Summed by the topology, so banded models only visit (and re-estimate) their allowed arcs
+        """
+
+        # summed in float64 whatever the lattice precision, the shifts restore the absolute values
+        log_forward = self.forward[:, :-1]
+        log_backward = np.asarray(self.emission[:, 1:], dtype=float) + self._emission_shift[1:] + self.backward[:, 1:]
+
+        return self.transitions.log_transition_sums(log_forward.T, log_backward.T, self.observation_likelihood)
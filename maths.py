@@ -1,9 +1,11 @@
-from math import sqrt, pi
+from math import sqrt, pi, log
 
 import numpy as np
 from numpy import exp
+from numpy import log as ln
 
 root_2_pi = sqrt(2. * pi) # square root is expensive, define as constant here
+ln_root_2_pi = log(root_2_pi)
 
 def gaussian(x: float, mu: float, sd: float):
     mu_pert = x - mu # mean pertubation
@@ -12,4 +14,117 @@ def gaussian(x: float, mu: float, sd: float):
 
     return coefficient * exp( - (mu_pert**2)
                                         /
-                                    (2.*sd**2))
\ No newline at end of file
+                                    (2.*sd**2))
+
+def log_gaussian(x: float, mu: float, sd: float):
+    """Natural log of gaussian(), evaluated directly so tails don't underflow to -inf"""
+    mu_pert = x - mu # mean pertubation
+
+    return - ln(sd) - ln_root_2_pi - (mu_pert**2) / (2.*sd**2)
+
+def logsumexp(a, axis=None):
+    """ln( sum( exp(a) ) ) along an axis without leaving log space, -inf safe"""
+    a = np.asarray(a)
+    a_max = max_shift(a, axis=axis)
+
+    with np.errstate(divide='ignore'): # ln(0) = -inf is valid here
+        summed = ln(np.sum(exp(a - a_max), axis=axis, keepdims=True)) + a_max
+
+    if axis is None:
+        return summed.reshape(())[()]
+    return np.squeeze(summed, axis=axis)
+
+
+def max_shift(a, axis=None):
+    """Max along an axis (kept as length 1) to subtract from a, 0 for all -inf slices so -inf - -inf can't be nan"""
+    shift = np.max(a, axis=axis, keepdims=True)
+    shift[~np.isfinite(shift)] = 0
+    return shift
+
+
+def shifted_exp(a, axis: int, out=None):
+    """(exp(a - shift), shift), shift the max along axis so every slice peaks at 1 and can't underflow
+
+    shift is float64 without the axis, out may be lower precision than a
+    """
+    a = np.asarray(a, dtype=float)
+    shift = max_shift(a, axis=axis)
+    out = exp(a - shift, out=out)
+    return out, np.squeeze(shift, axis=axis)
+
+
+####################################
+#    Vectorised State Densities
+####################################
+
+def broadcast_states(observations, values, state_axis: int):
+    """Line up per-state values against an observation array, states on the first or last axis"""
+    if state_axis == 0:
+        return observations[np.newaxis, ...], values.reshape((-1,) + (1,) * observations.ndim)
+    return observations[..., np.newaxis], values
+
+def log_gaussian_matrix(observations, parameters, out=None, state_axis: int = 0):
+    """ln(b_j(o_t)) for every state/observation pair in one pass, N x T by default (state_axis=-1 gives T x N)
+
+    parameters is a StateParameters, its cached log normalisers and inverse variances replace the 
+    per-call sqrt/divisions of log_gaussian(), out is an optional preallocated result buffer.
+    N x D parameters take T x D feature vectors with diagonal covariance
+    """
+    observations = np.asarray(observations, dtype=float)
+    if parameters.means.ndim == 2:
+        return log_diagonal_gaussian_matrix(observations, parameters, out=out, state_axis=state_axis)
+
+    x, means = broadcast_states(observations, parameters.means, state_axis)
+    out = np.subtract(x, means, out=out) # mean pertubation
+    np.square(out, out=out)
+
+    _, inverse_variances = broadcast_states(observations, parameters.inverse_variances, state_axis)
+    out *= -0.5 * inverse_variances
+
+    _, log_normalisers = broadcast_states(observations, parameters.log_normalisers, state_axis)
+    out += log_normalisers
+
+    return out
+
+def place_states(frames_by_state, frame_shape, out=None, state_axis: int = 0):
+    """Reshape a (frames x N) result back to the observation layout with states first or last"""
+    result = frames_by_state.reshape(frame_shape + frames_by_state.shape[-1:])
+    if state_axis == 0:
+        result = np.moveaxis(result, -1, 0)
+
+    if out is None:
+        return np.ascontiguousarray(result)
+    out[...] = result
+    return out
+
+def log_diagonal_gaussian_matrix(observations, parameters, out=None, state_axis: int = 0):
+    """Diagonal covariance ln(b_j(o_t)) for ... x D observations as three matrix products over every state"""
+    frames = observations.reshape(-1, observations.shape[-1])
+    means = parameters.means
+    inverse_variances = parameters.inverse_variances
+
+    # sum_d( (o_d - mean_d)^2 / var_d ) expanded into frames x D @ D x N products
+    quadratic = ((frames ** 2) @ inverse_variances.T 
+                 - 2. * (frames @ (means * inverse_variances).T) 
+                 + np.sum(means ** 2 * inverse_variances, axis=1))
+
+    return place_states(parameters.log_normalisers - 0.5 * quadratic, observations.shape[:-1], out=out, state_axis=state_axis)
+
+def log_full_gaussian_matrix(observations, parameters, out=None, state_axis: int = 0):
+    """Full covariance ln(b_j(o_t)) for ... x D observations, whitened with the cached inverse Cholesky factors"""
+    observations = np.asarray(observations, dtype=float)
+    frames = observations.reshape(-1, observations.shape[-1])
+    inverse_cholesky = parameters.inverse_cholesky
+
+    # z = L^-1 (o - mean) for every state at once, N x frames x D
+    whitened = np.matmul(frames[np.newaxis, :, :], np.swapaxes(inverse_cholesky, 1, 2))
+    whitened -= np.matmul(inverse_cholesky, parameters.means[:, :, np.newaxis])[:, np.newaxis, :, 0]
+    mahalanobis = np.sum(whitened ** 2, axis=2) # N x frames
+
+    return place_states((parameters.log_normalisers[:, np.newaxis] - 0.5 * mahalanobis).T, 
+                        observations.shape[:-1], out=out, state_axis=state_axis)
+
+def gaussian_matrix(observations, parameters, out=None, state_axis: int = 0):
+    """b_j(o_t) for every state/observation pair in one pass, see log_gaussian_matrix()"""
+    out = log_gaussian_matrix(observations, parameters, out=out, state_axis=state_axis)
+    return exp(out, out=out)
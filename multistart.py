@@ -0,0 +1,169 @@
+from dataclasses import dataclass
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from parameters import StateParameters, as_state_parameters
+from topology import BandedTransitions, as_transitions
+from training import TrainingResult, TrainingTrace, fit, is_single_sequence
+
+
+@dataclass(frozen=True)
+class MultiStartResult:
+    results: list  # TrainingResult per start, pruned ones as they were when dropped
+    pruned: np.ndarray  # starts dropped for trailing the leader
+    best_index: int
+
+    @property
+    def best(self):
+        return self.results[self.best_index]
+
+    @property
+    def traces(self):
+        return [result.trace for result in self.results]
+
+
+####################################
+#          Initialisations
+####################################
+
+def perturbed_transitions(state_transitions, rng, scale: float):
+    """Multiplicative noise on every allowed arc, rows renormalised, structural zeros and banding kept"""
+    transitions = as_transitions(state_transitions)
+    padded = transitions.padded * np.exp(scale * rng.standard_normal(transitions.padded.shape))
+
+    totals = np.sum(padded, axis=1, keepdims=True)
+    padded = np.divide(padded, totals, out=np.zeros_like(padded), where=totals > 0) # final row stays empty
+
+    if isinstance(transitions, BandedTransitions):
+        return BandedTransitions.from_dense(padded, offsets=transitions.offsets)
+    return padded
+
+
+def perturbed_starts(states, state_transitions, count: int, scale: float = 0.5, seed: int = None):
+    """count (StateParameters, state_transitions) starts jittered around the given ones, the first unchanged
+
+    means move by scale standard deviations, variances and transition probs by a factor of about exp(scale)
+    """
+    rng = np.random.default_rng(seed)
+    parameters = as_state_parameters(states)
+    starts = [(parameters, state_transitions)]
+
+    for _ in range(count - 1):
+        means = parameters.means + scale * parameters.std_devs * rng.standard_normal(parameters.means.shape)
+        variances = parameters.variances * np.exp(scale * rng.standard_normal(parameters.variances.shape))
+        starts.append((StateParameters(means=means, variances=variances),
+                       perturbed_transitions(state_transitions, rng, scale)))
+    return starts
+
+
+def random_starts(sequences: list, state_transitions, count: int, scale: float = 0.5, seed: int = None):
+    """count starts with means drawn from random training frames and the training set's variance
+
+    transitions are jittered as in perturbed_starts(), sequences is a list of sequences
+    """
+    rng = np.random.default_rng(seed)
+    frames = np.concatenate([np.asarray(sequence, dtype=float) for sequence in sequences])
+    state_count = as_transitions(state_transitions).state_count
+    variances = np.broadcast_to(np.var(frames, axis=0), (state_count,) + frames.shape[1:])
+
+    starts = []
+    for _ in range(count):
+        means = frames[rng.choice(len(frames), size=state_count, replace=len(frames) < state_count)]
+        starts.append((StateParameters(means=means, variances=variances),
+                       perturbed_transitions(state_transitions, rng, scale)))
+    return starts
+
+
+####################################
+#         Worker Processes
+####################################
+
+worker_sequences = None
+
+
+def initialise_worker(sequences: list):
+    """Pool initialiser, keeps the training set for every round"""
+    global worker_sequences
+    worker_sequences = sequences
+
+
+def train_start(task: tuple):
+    """Baum-Welch for one start over the worker's training set"""
+    parameters, state_transitions, max_iterations, tolerance = task
+    return fit(parameters, worker_sequences, state_transitions, max_iterations=max_iterations, tolerance=tolerance)
+
+
+def extend_trace(trace: TrainingTrace, more: TrainingTrace, tolerance: float):
+    """One trace from two consecutive rounds, also converged if the round boundary didn't improve"""
+    if trace is None:
+        return more
+
+    converged = more.converged or more.log_likelihood[0] - trace.log_likelihood[-1] < tolerance
+    return TrainingTrace(log_likelihood=np.concatenate([trace.log_likelihood, more.log_likelihood]),
+                         means=np.concatenate([trace.means, more.means]),
+                         variances=np.concatenate([trace.variances, more.variances]),
+                         elapsed=np.concatenate([trace.elapsed, trace.elapsed[-1] + more.elapsed]),
+                         converged=converged)
+
+
+def traces_length(trace: TrainingTrace):
+    """Iterations run so far, 0 before the first round"""
+    return 0 if trace is None else trace.iterations
+
+
+####################################
+#             Trainer
+####################################
+
+def fit_multistart(starts: list, sequences: list, max_iterations: int = 50, tolerance: float = 1e-4,
+                   prune_after: int = 5, margin: float = 10., processes: int = None, callback=None):
+    """Baum-Welch from every (states, state_transitions) start at once over a process pool, keep the best
+
+    starts run in rounds of prune_after iterations, after each round any start whose log likelihood
+    trails the leader's by more than margin is dropped (margin=None never prunes). callback(round,
+    log_likelihoods, pruned) is called after every round. Returns a MultiStartResult, every start's
+    model and trace, best is the highest final log likelihood
+    """
+    if is_single_sequence(sequences, as_state_parameters(starts[0][0]).feature_shape):
+        sequences = [sequences]
+
+    results = [None] * len(starts)
+    traces = [None] * len(starts)
+    models = [(as_state_parameters(states), state_transitions) for states, state_transitions in starts]
+    pruned = np.zeros(len(starts), dtype=bool)
+    finished = np.zeros(len(starts), dtype=bool)
+
+    with Pool(min(processes or cpu_count(), len(starts)), initializer=initialise_worker,
+              initargs=(sequences,)) as pool:
+        round_index = 0
+        while True:
+            running = np.flatnonzero(~pruned & ~finished)
+            if len(running) == 0:
+                break
+
+            iterations = [min(prune_after, max_iterations - traces_length(traces[index])) for index in running]
+            round_results = pool.map(train_start, [models[index] + (count, tolerance)
+                                                   for index, count in zip(running, iterations)])
+
+            for index, result in zip(running, round_results):
+                traces[index] = extend_trace(traces[index], result.trace, tolerance)
+                models[index] = (result.parameters, result.state_transitions)
+                results[index] = TrainingResult(parameters=result.parameters,
+                                                state_transitions=result.state_transitions,
+                                                trace=traces[index])
+                finished[index] = traces[index].converged or traces[index].iterations >= max_iterations
+
+            # every start that has run so far competes for the lead, finished ones included, a start
+            # that degenerated (a state lost all its frames) scores nan and counts as -inf
+            log_likelihoods = np.array([-np.inf if trace is None else trace.log_likelihood[-1] for trace in traces])
+            log_likelihoods[np.isnan(log_likelihoods)] = -np.inf
+            if margin is not None:
+                pruned |= ~finished & (log_likelihoods < np.max(log_likelihoods) - margin)
+
+            if callback is not None:
+                callback(round_index, log_likelihoods, pruned.copy())
+            round_index += 1
+
+    final = np.array([result.trace.log_likelihood[-1] for result in results])
+    return MultiStartResult(results=results, pruned=pruned, best_index=int(np.argmax(np.nan_to_num(final, nan=-np.inf))))
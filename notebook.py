@@ -7,12 +7,15 @@ import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 from matplotlib.pyplot import savefig
 import numpy as np
-from math import sqrt
+import os
 
 from constants import *
-from maths import gaussian
+from maths import gaussian, gaussian_matrix
 from markov import MarkovModel
+from parameters import StateParameters
 from markovlog import LogMarkovModel
+from training import fit
+from persistence import load_result, save_result
 
 fig_dpi = 200
 fig_export = False
@@ -21,13 +24,14 @@ x = np.linspace(-4, 8, 300) # x values for figures
 x_label = "Observation Space"
 y_label = "Probability Density"
 
+initial_parameters = StateParameters.from_states([state1, state2])
+
 # %% [markdown]
 # State Probability Functions (1)
 # ===================
 
 # %%
-state_1_y = [gaussian(i, state1.mean, state1.std_dev) for i in x]
-state_2_y = [gaussian(i, state2.mean, state2.std_dev) for i in x]
+state_1_y, state_2_y = gaussian_matrix(x, initial_parameters)
 
 plt.plot(x, state_1_y, c='r', label="State 1")
 plt.plot(x, state_2_y, c='b', label="State 2")
@@ -57,8 +61,7 @@ for obs in observations:
 
 
 # %%
-state_1_y = [gaussian(i, state1.mean, state1.std_dev) for i in x]
-state_2_y = [gaussian(i, state2.mean, state2.std_dev) for i in x]
+state_1_y, state_2_y = gaussian_matrix(x, initial_parameters)
 
 plt.plot(x, state_1_y, c='r', label="State 1")
 plt.plot(x, state_2_y, c='b', label="State 2")
@@ -70,8 +73,7 @@ plt.xlabel(x_label)
 plt.ylabel(y_label)
 plt.grid(linestyle="--", axis='y')
 
-state1_pd = [gaussian(i, state1.mean, state1.std_dev) for i in observations]
-state2_pd = [gaussian(i, state2.mean, state2.std_dev) for i in observations]
+state1_pd, state2_pd = gaussian_matrix(observations, initial_parameters)
 
 #############################################
 #             Observation Marks  
@@ -100,12 +102,12 @@ plt.show()
 model = MarkovModel(states=[state1, state2], 
                     observations=observations, 
                     state_transitions=state_transition)
-model.populate_forward()
+# lattices are built lazily on first access and cached
 
 print(model.forward)
 
 forward = model.forward
-model.calculate_p_obs_forward()
+model.p_obs_forward
 
 
 # %%
@@ -143,12 +145,11 @@ plt.show()
 model = MarkovModel(states=[state1, state2], 
                     observations=observations, 
                     state_transitions=state_transition)
-model.populate_backward()
 
 print(model.backward)
 
 backward = model.backward
-model.calculate_p_obs_backward()
+model.p_obs_backward
 
 
 # %%
@@ -186,11 +187,8 @@ plt.show()
 model = MarkovModel(states=[state1, state2], 
                     observations=observations, 
                     state_transitions=state_transition)
-model.populate_forward()
-model.populate_backward()
-
-print("forward:", model.calculate_p_obs_forward())
-print("backward:", model.calculate_p_obs_backward())
+print("forward:", model.p_obs_forward)
+print("backward:", model.p_obs_backward)
 
 print("diff: ", model.p_obs_forward - model.p_obs_backward)
 
@@ -292,10 +290,8 @@ model = MarkovModel(states=[state1, state2],
 
 new_mean = model.reestimated_mean()
 new_var = model.reestimated_variance()
-new_std_dev = [sqrt(x) for x in new_var]
 
-state_1_y = [gaussian(i, new_mean[0], new_std_dev[0]) for i in x]
-state_2_y = [gaussian(i, new_mean[1], new_std_dev[1]) for i in x]
+state_1_y, state_2_y = gaussian_matrix(x, StateParameters(new_mean, new_var))
 
 plt.plot(x, state_1_y, c='r', label="State 1")
 plt.plot(x, state_2_y, c='b', label="State 2")
@@ -321,21 +317,18 @@ model = MarkovModel(states=[state1, state2],
 
 new_mean = model.reestimated_mean()
 new_var = model.reestimated_variance()
-new_std_dev = [sqrt(x) for x in new_var]
 
 #######################################
 #              Original
 #######################################
-state_1_y = [gaussian(i, state1.mean, state1.std_dev) for i in x]
-state_2_y = [gaussian(i, state2.mean, state2.std_dev) for i in x]
+state_1_y, state_2_y = gaussian_matrix(x, initial_parameters)
 plt.plot(x, state_1_y, '--', c='r', label="State 1", linewidth=1.0)
 plt.plot(x, state_2_y, '--', c='b', label="State 2", linewidth=1.0)
 
 #######################################
 #            Re-Estimated
 #######################################
-state_1_new_y = [gaussian(i, new_mean[0], new_std_dev[0]) for i in x]
-state_2_new_y = [gaussian(i, new_mean[1], new_std_dev[1]) for i in x]
+state_1_new_y, state_2_new_y = gaussian_matrix(x, StateParameters(new_mean, new_var))
 plt.plot(x, state_1_new_y, c='r', label="New State 1")
 plt.plot(x, state_2_new_y, c='b', label="New State 2")
 
@@ -362,38 +355,55 @@ iterations = 50
 fig = plt.figure(dpi=fig_dpi, tight_layout=True)
 ax = fig.add_subplot(1, 1, 1, xmargin=0, ymargin=0)
 
-iter_mean = [state1.mean, state2.mean]
-iter_var = [state1.variance, state2.variance]
-iter_state_transitions = state_transition
-
-ax.plot(x, [gaussian(i, iter_mean[0], sqrt(iter_var[0])) for i in x], '--', c='r', linewidth=1.0)
-ax.plot(x, [gaussian(i, iter_mean[1], sqrt(iter_var[1])) for i in x], '--', c='b', linewidth=1.0)
+model_path = "trained-model"
+reuse_trained_model = False # opt in to loading the saved run, only used while its inputs still match
+
+# everything the saved run depends on, compared on load so edits to constants.py re-train
+training_inputs = {'observations': np.asarray(observations, dtype=float),
+                   'state_transitions': np.asarray(state_transition, dtype=float),
+                   'means': np.array([state1.mean, state2.mean]),
+                   'variances': np.array([state1.variance, state2.variance]),
+                   'iterations': np.array(iterations)}
+
+def saved_inputs_match(path):
+    inputs_path = os.path.join(path, "inputs.npz")
+    if not os.path.exists(inputs_path):
+        return False
+    with np.load(inputs_path) as saved:
+        return (set(saved.files) == set(training_inputs) 
+                and all(np.array_equal(saved[name], value) for name, value in training_inputs.items()))
+
+if reuse_trained_model and saved_inputs_match(model_path):
+    result = load_result(model_path)
+else:
+    result = fit(states=[state1, state2], 
+                 sequences=observations, 
+                 state_transitions=state_transition, 
+                 max_iterations=iterations)
+    save_result(model_path, result)
+    np.savez(os.path.join(model_path, "inputs.npz"), **training_inputs)
+trace = result.trace
+
+print(f"{trace.iterations} iterations, converged: {trace.converged}")
+print("log likelihood: ", trace.log_likelihood)
+print(result.state_transitions)
 
 label1=None
 label2=None
 
-for i in range(iterations):
-    iter_model = MarkovModel(states=[State(iter_mean[0], iter_var[0], state1.entry, state1.exit), 
-                                     State(iter_mean[1], iter_var[1], state2.entry, state2.exit)],
-                             observations=observations,
-                             state_transitions=iter_state_transitions).populate()
-
-    # NEW PARAMETERS
-    iter_mean = iter_model.reestimated_mean()
-    iter_var = iter_model.reestimated_variance()
-    iter_state_transitions[1:3, 1:3] = iter_model.reestimated_state_transitions()
+for i, (iter_mean, iter_var) in enumerate(zip([*trace.means, [s.mean for s in result.states]], 
+                                              [*trace.variances, [s.variance for s in result.states]])):
+    # row 0 is the initial parameters, the final row the trained states
 
     print(f"mean ({i}): ", iter_mean)
     print(f"var ({i}): ", iter_var)
-    print(iter_model.reestimated_state_transitions())
     print()
 
-    state_1_y = [gaussian(i, iter_mean[0], sqrt(iter_var[0])) for i in x]
-    state_2_y = [gaussian(i, iter_mean[1], sqrt(iter_var[1])) for i in x]
+    state_1_y, state_2_y = gaussian_matrix(x, StateParameters(iter_mean, iter_var))
 
     style = '--'
     linewidth = 1.0
-    if i == iterations - 1:
+    if i == trace.iterations:
         style = '-'
         linewidth = 2.0
         label1='State 1'
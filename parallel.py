@@ -0,0 +1,194 @@
+from dataclasses import replace
+from multiprocessing import Pool, cpu_count
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from batch import BatchMarkovModel
+from parameters import StateParameters, as_state_parameters
+from topology import BandedTransitions, DenseTransitions, as_transitions
+from training import baum_welch, is_single_sequence
+
+
+class SharedParameters:
+    """Means, variances and state transitions published to every worker through one shared memory block
+
+    Holds StateParameters, scalar or diagonal covariance with feature_shape = (D,). Transitions are the
+    padded matrix, or with offsets the entry/bands/exit of a BandedTransitions so workers run banded
+    """
+
+    def __init__(self, state_count: int, feature_shape: tuple = (), name: str = None, offsets=None):
+        self.state_count = state_count
+        self.feature_shape = tuple(feature_shape)
+        self.offsets = None if offsets is None else np.asarray(offsets, dtype=int)
+        parameter_size = state_count * int(np.prod(self.feature_shape, dtype=int))
+        transition_size = (state_count + 2) ** 2 if self.offsets is None else state_count * (len(self.offsets) + 2)
+        size = (2 * parameter_size + transition_size) * np.dtype(float).itemsize
+
+        self.owner = name is None
+        self.memory = SharedMemory(create=True, size=size) if self.owner else SharedMemory(name=name)
+
+        buffer = np.ndarray((size // np.dtype(float).itemsize,), dtype=float, buffer=self.memory.buf)
+        parameter_shape = (state_count,) + self.feature_shape
+        self.means = buffer[:parameter_size].reshape(parameter_shape)
+        self.variances = buffer[parameter_size:2 * parameter_size].reshape(parameter_shape)
+
+        transitions = buffer[2 * parameter_size:]
+        self.state_transitions = self.entry = self.bands = self.exit = None
+        if self.offsets is None:
+            self.state_transitions = transitions.reshape(state_count + 2, state_count + 2)
+        else:
+            band_size = state_count * len(self.offsets)
+            self.entry = transitions[:state_count]
+            self.bands = transitions[state_count:state_count + band_size].reshape(state_count, len(self.offsets))
+            self.exit = transitions[state_count + band_size:]
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def publish(self, states, state_transitions):
+        """Write new parameters in place, workers see them on their next task
+
+        transitions are stored in this block's layout whatever the caller's, returns that topology
+        """
+        parameters = as_state_parameters(states)
+        self.means[:] = parameters.means
+        self.variances[:] = parameters.variances
+
+        transitions = as_transitions(state_transitions)
+        if self.offsets is None:
+            self.state_transitions[:] = transitions.padded
+        else:
+            if not (isinstance(transitions, BandedTransitions) and np.array_equal(transitions.offsets, self.offsets)):
+                transitions = BandedTransitions.from_dense(transitions.padded, offsets=self.offsets)
+            self.entry[:] = transitions.entry
+            self.bands[:] = transitions.bands
+            self.exit[:] = transitions.exit
+        return self.read_transitions()
+
+    def read(self):
+        """Private copy of the current state parameters"""
+        return StateParameters(means=self.means.copy(), variances=self.variances.copy())
+
+    def read_transitions(self):
+        """Private copy of the current state transitions, DenseTransitions or BandedTransitions"""
+        if self.offsets is None:
+            return DenseTransitions(self.state_transitions.copy())
+        return BandedTransitions(entry=self.entry.copy(), bands=self.bands.copy(),
+                                 offsets=self.offsets, exit=self.exit.copy())
+
+    def close(self):
+        # drop views into the buffer before releasing it
+        del self.means, self.variances, self.state_transitions, self.entry, self.bands, self.exit
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def same_layout(transitions, other):
+    """True when both topologies store a_ij the same way, dense or banded on the same diagonals"""
+    if isinstance(transitions, BandedTransitions) and isinstance(other, BandedTransitions):
+        return np.array_equal(transitions.offsets, other.offsets)
+    return isinstance(transitions, DenseTransitions) and isinstance(other, DenseTransitions)
+
+
+####################################
+#         Worker Processes
+####################################
+
+worker_parameters = None
+worker_sequences = None
+worker_model = None # one BatchMarkovModel per worker, its lattice buffers reused between tasks
+worker_shard = None # shard index loaded into worker_model
+
+
+def initialise_worker(parameters_name: str, state_count: int, feature_shape: tuple, sequences: list, offsets=None):
+    """Pool initialiser, attaches to the shared parameters and keeps the training set for every iteration"""
+    global worker_parameters, worker_sequences
+    worker_parameters = SharedParameters(state_count, feature_shape, name=parameters_name, offsets=offsets)
+    worker_sequences = sequences
+
+
+def shard_expectation(shard: tuple):
+    """E-step for one shard of sequences against the currently published parameters
+
+    pool.map hands shards to whichever worker is free, so each worker keeps a single model and
+    loads the shard it was given, lattice memory stays at one shard per process
+    """
+    global worker_model, worker_shard
+    shard_index, sequence_indices = shard
+
+    states = worker_parameters.read()
+    state_transitions = worker_parameters.read_transitions()
+    sequences = [worker_sequences[index] for index in sequence_indices]
+
+    if worker_model is None:
+        worker_model = BatchMarkovModel(states, sequences, state_transitions)
+    else:
+        worker_model.states = states
+        worker_model.state_transitions = state_transitions
+        if worker_shard != shard_index:
+            worker_model.set_sequences(sequences)
+    worker_shard = shard_index
+
+    worker_model.populate()
+    return worker_model.accumulate(), worker_model.observation_likelihood
+
+
+####################################
+#             Trainer
+####################################
+
+class ParallelTrainer:
+    """Baum-Welch over a process pool, sequences sharded across workers and statistics summed once per iteration
+
+    The training set goes to each worker once when the pool starts, every iteration only the shared
+    parameter block is rewritten and each shard sends back its small BaumWelchStatistics. offsets
+    (a BandedTransitions' diagonals) publish banded transitions so the workers' recursions are O(N * K)
+    """
+
+    def __init__(self, sequences: list, state_count: int, processes: int = None, shards: int = None,
+                 feature_shape: tuple = (), offsets=None):
+        if is_single_sequence(sequences, feature_shape):
+            sequences = [sequences]
+
+        self.processes = processes or cpu_count()
+        shards = min(shards or self.processes, len(sequences))
+        self.shards = list(enumerate(np.array_split(np.arange(len(sequences)), shards)))
+
+        self.parameters = SharedParameters(state_count, feature_shape, offsets=offsets)
+        self.pool = Pool(self.processes, initializer=initialise_worker,
+                         initargs=(self.parameters.name, state_count, feature_shape, sequences, offsets))
+
+    def expectation(self, states: list, state_transitions: np.ndarray):
+        """Parallel E-step, publish parameters then reduce every shard's statistics"""
+        published = self.parameters.publish(states, state_transitions)
+
+        results = self.pool.map(shard_expectation, self.shards)
+        statistics = sum((result[0] for result in results[1:]), results[0][0])
+
+        # sums come back in the workers' layout, convert to the caller's only if they differ
+        transitions = as_transitions(state_transitions)
+        if not same_layout(published, transitions):
+            statistics = replace(statistics, transitions=transitions.band(published.to_matrix(statistics.transitions)))
+        return statistics, sum(result[1] for result in results)
+
+    def fit(self, states: list, state_transitions: np.ndarray,
+            max_iterations: int = 50, tolerance: float = 1e-4, time_budget: float = None,
+            callback=None):
+        """Train like training.fit() with the E-step spread over the pool"""
+        return baum_welch(self.expectation, states, state_transitions,
+                          max_iterations=max_iterations, tolerance=tolerance,
+                          time_budget=time_budget, callback=callback)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.parameters.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,278 @@
+from dataclasses import dataclass, field
+from math import pi
+
+import numpy as np
+
+from constants import State
+from maths import gaussian_matrix, log_gaussian_matrix, log_full_gaussian_matrix, logsumexp, place_states
+
+
+@dataclass(frozen=True)
+class StateParameters:
+    """Struct-of-arrays gaussian state parameters, one contiguous array per parameter
+
+    means/variances are N for scalar observations or N x D for feature vectors (diagonal covariance).
+    Derived constants are computed once on construction so the engines never take a sqrt or
+    a log per state per frame. Entry/exit probs live only in the padded state transitions
+    """
+    means: np.ndarray
+    variances: np.ndarray
+
+    std_devs: np.ndarray = field(init=False, repr=False, compare=False)
+    inverse_variances: np.ndarray = field(init=False, repr=False, compare=False)
+    log_normalisers: np.ndarray = field(init=False, repr=False, compare=False)  # ln( 1 / sqrt(2 pi var) ), N
+
+    def __post_init__(self):
+        # frozen, derived fields set through object
+        means = np.ascontiguousarray(self.means, dtype=float)
+        variances = np.ascontiguousarray(self.variances, dtype=float)
+
+        object.__setattr__(self, 'means', means)
+        object.__setattr__(self, 'variances', variances)
+        object.__setattr__(self, 'std_devs', np.sqrt(variances))
+        object.__setattr__(self, 'inverse_variances', 1. / variances)
+
+        log_normalisers = -0.5 * np.log(2. * pi * variances)
+        if variances.ndim == 2: # independent dimensions multiply
+            log_normalisers = np.sum(log_normalisers, axis=1)
+        object.__setattr__(self, 'log_normalisers', log_normalisers)
+
+    def __len__(self):
+        return len(self.means)
+
+    @property
+    def feature_shape(self):
+        """Shape of one observation, () for scalars or (D,)"""
+        return self.means.shape[1:]
+
+    @classmethod
+    def from_states(cls, states: list):
+        """Pack a list of State dataclasses"""
+        return cls(means=np.array([state.mean for state in states], dtype=float),
+                   variances=np.array([state.variance for state in states], dtype=float))
+
+    def to_states(self, state_transitions: np.ndarray = None):
+        """Unpack to State dataclasses, entry/exit read from padded state transitions when given"""
+
+        states = []
+        for index, (mean, variance) in enumerate(zip(self.means, self.variances)):
+            entry = exit = 0.
+            if state_transitions is not None:
+                entry = float(state_transitions[0, index + 1])
+                exit = float(state_transitions[index + 1, -1])
+            states.append(State(float(mean), float(variance), entry, exit))
+
+        return states
+
+    ####################################
+    #            Emissions
+    ####################################
+
+    def log_emission(self, observations, out=None, state_axis: int = 0, cache: dict = None):
+        """ln(b_j(o_t)) for every state/observation, N x T (state_axis=-1 gives T x N)
+
+        cache is an engine owned dict handed to weighted_statistics() later in the same E-step, only
+        MixtureStateParameters keeps anything in it
+        """
+        return log_gaussian_matrix(observations, self, out=out, state_axis=state_axis)
+
+    def emission(self, observations, out=None, state_axis: int = 0, cache: dict = None):
+        """b_j(o_t) for every state/observation, N x T (state_axis=-1 gives T x N)"""
+        return gaussian_matrix(observations, self, out=out, state_axis=state_axis)
+
+    ####################################
+    #     Baum-Welch Re-estimations
+    ####################################
+
+    def weighted_statistics(self, occupation, observations, cache: dict = None):
+        """Occupation weighted observations and squared errors about the current means
+
+        occupation is frames x N, observations frames (x D), returns N (x D) arrays keyed by 
+        their BaumWelchStatistics field
+        """
+        occupation = np.asarray(occupation, dtype=float)
+        observations = np.asarray(observations, dtype=float)
+
+        weighted_observations = occupation.T @ observations
+
+        if observations.ndim == 1:
+            squared_error = (observations[:, np.newaxis] - self.means) ** 2
+            return {'weighted_observations': weighted_observations, 
+                    'weighted_squares': np.sum(occupation * squared_error, axis=0)}
+
+        # sum_t( L (o - mean)^2 ) = sum_t( L o^2 ) - 2 mean sum_t( L o ) + mean^2 sum_t( L ), matrix products only
+        occupation_sum = np.sum(occupation, axis=0)[:, np.newaxis]
+        weighted_squares = (occupation.T @ observations ** 2
+                            - 2. * self.means * weighted_observations
+                            + self.means ** 2 * occupation_sum)
+        return {'weighted_observations': weighted_observations, 'weighted_squares': weighted_squares}
+
+    def reestimated(self, statistics):
+        """New parameters from summed BaumWelchStatistics"""
+        return StateParameters(means=statistics.reestimated_mean(),
+                               variances=statistics.reestimated_variance())
+
+
+@dataclass(frozen=True)
+class FullCovarianceStateParameters:
+    """Gaussian states over D dimensional feature vectors with full N x D x D covariances
+
+    Cholesky factors (and their inverses, for whitening observations) are cached on construction
+    """
+    means: np.ndarray
+    covariances: np.ndarray
+
+    cholesky: np.ndarray = field(init=False, repr=False, compare=False)  # lower triangular L, cov = L L^T
+    inverse_cholesky: np.ndarray = field(init=False, repr=False, compare=False)
+    log_normalisers: np.ndarray = field(init=False, repr=False, compare=False)  # ln( 1 / sqrt((2 pi)^D |cov|) ), N
+
+    def __post_init__(self):
+        means = np.ascontiguousarray(self.means, dtype=float)
+        covariances = np.ascontiguousarray(self.covariances, dtype=float)
+        cholesky = np.linalg.cholesky(covariances)
+        identity = np.broadcast_to(np.eye(means.shape[1]), covariances.shape)
+
+        object.__setattr__(self, 'means', means)
+        object.__setattr__(self, 'covariances', covariances)
+        object.__setattr__(self, 'cholesky', cholesky)
+        object.__setattr__(self, 'inverse_cholesky', np.linalg.solve(cholesky, identity))
+        object.__setattr__(self, 'log_normalisers',
+                           -0.5 * means.shape[1] * np.log(2. * pi)
+                           - np.sum(np.log(np.diagonal(cholesky, axis1=1, axis2=2)), axis=1))
+
+    def __len__(self):
+        return len(self.means)
+
+    @property
+    def feature_shape(self):
+        return self.means.shape[1:]
+
+    @property
+    def variances(self):
+        """Per dimension variances, the covariance diagonals"""
+        return np.diagonal(self.covariances, axis1=1, axis2=2)
+
+    def log_emission(self, observations, out=None, state_axis: int = 0, cache: dict = None):
+        return log_full_gaussian_matrix(observations, self, out=out, state_axis=state_axis)
+
+    def emission(self, observations, out=None, state_axis: int = 0, cache: dict = None):
+        out = log_full_gaussian_matrix(observations, self, out=out, state_axis=state_axis)
+        return np.exp(out, out=out)
+
+    def weighted_statistics(self, occupation, observations, cache: dict = None):
+        """Occupation weighted observations (N x D) and outer products about the current means (N x D x D)"""
+        occupation = np.asarray(occupation, dtype=float)
+        observations = np.asarray(observations, dtype=float)
+
+        weighted_observations = occupation.T @ observations
+        occupation_sum = np.sum(occupation, axis=0)[:, np.newaxis, np.newaxis]
+
+        # sum_t( L (o - mean)(o - mean)^T ), expanded so the only T sized work is one einsum
+        weighted_outer = np.einsum('tn,td,te->nde', occupation, observations, observations, optimize=True)
+        cross = self.means[:, :, np.newaxis] * weighted_observations[:, np.newaxis, :]
+        weighted_squares = (weighted_outer - cross - np.swapaxes(cross, 1, 2)
+                            + occupation_sum * self.means[:, :, np.newaxis] * self.means[:, np.newaxis, :])
+        return {'weighted_observations': weighted_observations, 'weighted_squares': weighted_squares}
+
+    def reestimated(self, statistics):
+        return FullCovarianceStateParameters(means=statistics.reestimated_mean(),
+                                             covariances=statistics.reestimated_variance())
+
+
+@dataclass(frozen=True)
+class MixtureStateParameters:
+    """Gaussian mixture states, N x M weights with N x M (x D) diagonal covariance components
+
+    Every component of every state is held as one flattened N * M StateParameters so all of them
+    are evaluated in a single batched log density call, then combined per state with logsumexp.
+    An engine's cache dict carries the frames x N x M component densities from log_emission() to
+    weighted_statistics() for the responsibilities, so an E-step evaluates them once
+    """
+    weights: np.ndarray
+    means: np.ndarray
+    variances: np.ndarray
+
+    components: StateParameters = field(init=False, repr=False, compare=False)  # N * M flattened components
+    log_weights: np.ndarray = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        weights = np.ascontiguousarray(self.weights, dtype=float)
+        means = np.ascontiguousarray(self.means, dtype=float)
+        variances = np.ascontiguousarray(self.variances, dtype=float)
+        component_count = weights.shape[0] * weights.shape[1]
+
+        object.__setattr__(self, 'weights', weights)
+        object.__setattr__(self, 'means', means)
+        object.__setattr__(self, 'variances', variances)
+        object.__setattr__(self, 'components', StateParameters(means=means.reshape((component_count,) + means.shape[2:]),
+                                                               variances=variances.reshape((component_count,) + variances.shape[2:])))
+        with np.errstate(divide='ignore'): # pruned components get -inf
+            object.__setattr__(self, 'log_weights', np.log(weights))
+
+    def __len__(self):
+        return len(self.weights)
+
+    @property
+    def feature_shape(self):
+        return self.means.shape[2:]
+
+    @property
+    def component_shape(self):
+        return self.weights.shape
+
+    def log_component_emission(self, observations):
+        """frames x N x M weighted component log densities, ln(c_jm) + ln(N(o_t; mean_jm, var_jm))"""
+        observations = np.asarray(observations, dtype=float)
+        frames = observations.reshape((-1,) + self.feature_shape)
+
+        log_components = self.components.log_emission(frames, state_axis=-1)
+        return log_components.reshape((len(frames),) + self.component_shape) + self.log_weights
+
+    def log_emission(self, observations, out=None, state_axis: int = 0, cache: dict = None):
+        """ln(b_j(o_t)) = ln( sum_m( c_jm N(o_t; mean_jm, var_jm) ) ), N x T (state_axis=-1 gives T x N)
+
+        the component densities are left in cache (when given) for weighted_statistics()
+        """
+        observations = np.asarray(observations, dtype=float)
+        frame_shape = observations.shape[:observations.ndim - len(self.feature_shape)]
+
+        log_components = self.log_component_emission(observations)
+        if cache is not None:
+            cache['log_components'] = log_components
+        log_emission = logsumexp(log_components, axis=2)
+        return place_states(log_emission, frame_shape, out=out, state_axis=state_axis)
+
+    def emission(self, observations, out=None, state_axis: int = 0, cache: dict = None):
+        out = self.log_emission(observations, out=out, state_axis=state_axis, cache=cache)
+        return np.exp(out, out=out)
+
+    def weighted_statistics(self, occupation, observations, cache: dict = None):
+        """Per component occupation and weighted sums, L_jm(t) = L_j(t) * c_jm N_jm(o_t) / b_j(o_t)
+
+        reuses the component densities log_emission() left in cache for the same frames, else evaluates them
+        """
+        occupation = np.asarray(occupation, dtype=float)
+
+        log_components = None if cache is None else cache.get('log_components')
+        if log_components is None:
+            log_components = self.log_component_emission(observations)
+        responsibilities = np.exp(log_components - logsumexp(log_components, axis=2)[:, :, np.newaxis])
+        component_occupation = (occupation[:, :, np.newaxis] * responsibilities).reshape(len(occupation), -1)
+
+        # flattened components re-use the single gaussian sums, reshaped back to N x M (x D)
+        statistics = self.components.weighted_statistics(component_occupation, observations)
+        statistics = {name: value.reshape(self.component_shape + value.shape[1:]) for name, value in statistics.items()}
+        statistics['component_occupation'] = np.sum(component_occupation, axis=0).reshape(self.component_shape)
+        return statistics
+
+    def reestimated(self, statistics):
+        return MixtureStateParameters(weights=statistics.reestimated_weights(),
+                                      means=statistics.reestimated_mean(),
+                                      variances=statistics.reestimated_variance())
+
+
+def as_state_parameters(states):
+    """Accept either array backed parameters or a list of State, engines only ever read the arrays"""
+    if isinstance(states, (StateParameters, FullCovarianceStateParameters, MixtureStateParameters)):
+        return states
+    return StateParameters.from_states(states)
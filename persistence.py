@@ -0,0 +1,113 @@
+import json
+import os
+from dataclasses import fields
+
+import numpy as np
+
+from parameters import StateParameters, FullCovarianceStateParameters, MixtureStateParameters, as_state_parameters
+from topology import BandedTransitions
+from training import TrainingResult, TrainingTrace
+
+FORMAT_VERSION = 1
+
+PARAMETER_TYPES = {cls.__name__: cls for cls in (StateParameters, FullCovarianceStateParameters, MixtureStateParameters)}
+
+LATTICES = ('forward', 'backward', 'occupation', 'scale')
+
+# A saved model is a directory:
+#   model.json       format version and which parameter/transition types to rebuild
+#   parameters.npz   constructor fields of the state parameters
+#   transitions.npz  padded matrix, or the banded fields
+#   trace.npz        optional TrainingTrace
+#   <lattice>.npy    optional, one raw .npy per lattice so each can be memory-mapped
+
+
+def init_fields(instance):
+    """Constructor fields of a parameters dataclass, derived fields are rebuilt on load"""
+    return {field.name: getattr(instance, field.name) for field in fields(instance) if field.init}
+
+
+####################################
+#        Parameters + Trace
+####################################
+
+def save_model(path: str, states, state_transitions, trace: TrainingTrace = None):
+    """Write state parameters, state transitions (padded or BandedTransitions) and an optional trace"""
+    os.makedirs(path, exist_ok=True)
+    parameters = as_state_parameters(states)
+
+    np.savez(os.path.join(path, 'parameters.npz'), **init_fields(parameters))
+
+    banded = isinstance(state_transitions, BandedTransitions)
+    if banded:
+        np.savez(os.path.join(path, 'transitions.npz'), **init_fields(state_transitions))
+    else:
+        np.savez(os.path.join(path, 'transitions.npz'), padded=np.asarray(state_transitions, dtype=float))
+
+    if trace is not None:
+        np.savez(os.path.join(path, 'trace.npz'), **init_fields(trace))
+
+    with open(os.path.join(path, 'model.json'), 'w') as file:
+        json.dump({'version': FORMAT_VERSION,
+                   'parameters': type(parameters).__name__,
+                   'transitions': 'banded' if banded else 'dense',
+                   'trace': trace is not None}, file)
+
+
+def save_result(path: str, result: TrainingResult):
+    """Write everything fit() returned"""
+    save_model(path, result.parameters, result.state_transitions, trace=result.trace)
+
+
+def load_result(path: str):
+    """Read a saved model back as a TrainingResult, trace is None when none was saved"""
+    with open(os.path.join(path, 'model.json')) as file:
+        header = json.load(file)
+    if header['version'] > FORMAT_VERSION:
+        raise ValueError('model format version {} is newer than supported ({})'.format(header['version'], FORMAT_VERSION))
+
+    with np.load(os.path.join(path, 'parameters.npz')) as saved:
+        parameters = PARAMETER_TYPES[header['parameters']](**saved)
+
+    with np.load(os.path.join(path, 'transitions.npz')) as saved:
+        if header['transitions'] == 'banded':
+            state_transitions = BandedTransitions(**saved)
+        else:
+            state_transitions = saved['padded']
+
+    trace = None
+    if header['trace']:
+        with np.load(os.path.join(path, 'trace.npz')) as saved:
+            trace = TrainingTrace(log_likelihood=saved['log_likelihood'], means=saved['means'],
+                                  variances=saved['variances'], elapsed=saved['elapsed'],
+                                  converged=bool(saved['converged']))
+
+    return TrainingResult(parameters=parameters, state_transitions=state_transitions, trace=trace)
+
+
+####################################
+#             Lattices
+####################################
+
+def save_lattices(path: str, model, names: tuple = LATTICES):
+    """Write a populated model's lattices as raw .npy files, MarkovModel or BatchMarkovModel
+
+    batch models also save their sequence lengths so padded frames can be told apart
+    """
+    os.makedirs(path, exist_ok=True)
+    if hasattr(model, 'lengths'):
+        names = tuple(names) + ('lengths',)
+
+    for name in names:
+        np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(getattr(model, name)))
+
+
+def load_lattices(path: str, names: tuple = None, mmap: bool = True):
+    """Read saved lattices, memory-mapped read only by default so nothing is copied until it's touched
+
+    every process mapping the same files shares their pages, returns {name: array}
+    """
+    if names is None:
+        names = [name for name in LATTICES + ('lengths',) if os.path.exists(os.path.join(path, name + '.npy'))]
+
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None) for name in names}
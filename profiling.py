@@ -0,0 +1,91 @@
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from time import perf_counter
+
+
+@dataclass
+class PhaseStats:
+    calls: int = 0
+    seconds: float = 0.  # wall time summed over every call
+
+
+@dataclass(frozen=True)
+class IterationStats:
+    iteration: int
+    log_likelihood: float  # ln(P(O|model)) going into the iteration
+    seconds: float  # wall time of the E and M steps
+
+
+@dataclass
+class Profiler:
+    """Opt-in instrumentation for the engines and training loop, pass as profiler= to switch on
+
+    Records wall time per phase, counters (emission densities evaluated, transition_likelihood calls),
+    lattice bytes allocated and every training iteration. on_phase(name, seconds) and
+    on_iteration(IterationStats) are called as each one finishes. Engines without a profiler only pay
+    for a None check per phase, never per frame. Engine phases never nest (a lazily built lattice's
+    inputs are timed as their own phases first) so they add up to the engine's wall time, training's
+    expectation/maximisation phases are the only ones that enclose others
+    """
+    on_phase: callable = None
+    on_iteration: callable = None
+
+    phases: dict = field(default_factory=dict)  # phase name -> PhaseStats
+    counters: Counter = field(default_factory=Counter)
+    lattice_bytes: int = 0
+    iterations: list = field(default_factory=list)  # IterationStats
+
+    @contextmanager
+    def phase(self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            stats = self.phases.setdefault(name, PhaseStats())
+            stats.calls += 1
+            stats.seconds += seconds
+            if self.on_phase is not None:
+                self.on_phase(name, seconds)
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] += amount
+
+    def allocated(self, *arrays):
+        """Add the bytes behind newly allocated lattice/emission buffers"""
+        self.lattice_bytes += sum(array.nbytes for array in arrays)
+
+    def iteration(self, iteration: int, log_likelihood: float, seconds: float):
+        stats = IterationStats(iteration=iteration, log_likelihood=float(log_likelihood), seconds=seconds)
+        self.iterations.append(stats)
+        if self.on_iteration is not None:
+            self.on_iteration(stats)
+
+    @property
+    def emission_evaluations(self):
+        """State x frame output densities computed so far"""
+        return self.counters['emission_evaluations']
+
+    def reset(self):
+        self.phases.clear()
+        self.counters.clear()
+        self.lattice_bytes = 0
+        self.iterations.clear()
+
+    def summary(self):
+        """Plain dict of everything recorded, ready for printing or json"""
+        return {
+            'phases': {name: {'calls': stats.calls, 'seconds': stats.seconds} for name, stats in self.phases.items()},
+            'counters': dict(self.counters),
+            'lattice_bytes': self.lattice_bytes,
+            'iterations': [{'iteration': stats.iteration, 'log_likelihood': stats.log_likelihood,
+                            'seconds': stats.seconds} for stats in self.iterations],
+        }
+
+
+def profiled(profiler: Profiler, name: str):
+    """profiler.phase(name), or a no-op context when profiling is off"""
+    if profiler is None:
+        return nullcontext()
+    return profiler.phase(name)
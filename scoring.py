@@ -0,0 +1,220 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+from batch import check_lengths, pad_sequences
+from parameters import StateParameters, as_state_parameters
+from topology import BandedTransitions, as_transitions, source_aligned
+
+
+@dataclass(frozen=True)
+class ScoreResult:
+    log_likelihood: np.ndarray  # M x S ln(P(O|model)), -inf where rejected
+    rejected: np.ndarray  # M x S, pruned by the beam before the end of the sequence
+
+    @property
+    def best(self):
+        """Index of the most likely model for every sequence"""
+        return np.argmax(self.log_likelihood, axis=0)
+
+
+def as_model(model):
+    """(parameters, transitions) from a (states, state_transitions) pair or a TrainingResult, banding kept"""
+    if hasattr(model, 'state_transitions'):
+        states, state_transitions = model.parameters, model.state_transitions
+    else:
+        states, state_transitions = model
+    return as_state_parameters(states), as_transitions(state_transitions)
+
+
+def topology_key(transitions):
+    """Models with equal keys step together, dense ones by state count, banded ones also by diagonals"""
+    if isinstance(transitions, BandedTransitions):
+        return 'banded', transitions.state_count, tuple(transitions.offsets)
+    return 'dense', transitions.state_count
+
+
+def pool_states(parameters: list):
+    """Every distinct gaussian across the models once, tied states (identical mean/variance) share a row
+
+    returns (pooled StateParameters, per model index arrays into it), None when the models aren't all
+    single gaussian StateParameters with the same feature shape
+    """
+    if not all(isinstance(model, StateParameters) for model in parameters):
+        return None
+    if len({model.feature_shape for model in parameters}) != 1:
+        return None
+
+    means = np.concatenate([model.means for model in parameters])
+    variances = np.concatenate([model.variances for model in parameters])
+    keys = np.hstack([means.reshape(len(means), -1), variances.reshape(len(variances), -1)])
+
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    pooled = StateParameters(means=means[first], variances=variances[first])
+
+    bounds = np.cumsum([0] + [len(model) for model in parameters])
+    inverse = inverse.reshape(-1)
+    return pooled, [inverse[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+class ModelGroup:
+    """Models sharing a topology key stacked G x N, one batched forward step advances all of them
+
+    dense groups hold G x N x N a_ij, banded groups G x N x K diagonals so they stay O(N * K)
+    """
+
+    def __init__(self, indices: list, transitions: list):
+        self.indices = np.array(indices, dtype=int)
+        self.entry = np.stack([model.entry for model in transitions])
+        self.exit = np.stack([model.exit for model in transitions])
+
+        self.offsets = None
+        if isinstance(transitions[0], BandedTransitions):
+            self.offsets = transitions[0].offsets
+            self.bands = np.stack([model.bands for model in transitions])
+        else:
+            self.matrix = np.stack([model.matrix for model in transitions])
+
+    def __len__(self):
+        return len(self.indices)
+
+    @property
+    def state_count(self):
+        return self.entry.shape[1]
+
+    def forward(self, values, rows):
+        """sum_i( values_i * a_ij ) for the G' x B x N values of the group's rows (a bool mask)"""
+        if self.offsets is None:
+            return np.matmul(values, self.matrix[rows]) # G' x B x N @ G' x N x N
+
+        bands = self.bands[rows, np.newaxis] # G' x 1 x N x K, broadcast over the batch
+        result = np.zeros_like(values)
+        for k, offset in enumerate(self.offsets):
+            result += source_aligned(values * bands[..., k], offset)
+        return result
+
+
+class ModelSet:
+    """Models grouped by topology (see topology_key()) so each group is stepped as one stacked array
+
+    a group only holds models with its own state count, nothing is padded up to the largest model,
+    and banded models only follow their diagonals
+    """
+
+    def __init__(self, models: list):
+        models = [as_model(model) for model in models]
+        self.parameters = [parameters for parameters, _ in models]
+        self.state_counts = np.array([len(parameters) for parameters in self.parameters])
+
+        grouped = {}
+        for index, (_, transitions) in enumerate(models):
+            grouped.setdefault(topology_key(transitions), []).append(index)
+        self.groups = [ModelGroup(indices, [models[index][1] for index in indices]) for indices in grouped.values()]
+
+        pooled = pool_states(self.parameters)
+        self.pooled = None
+        if pooled is not None:
+            self.pooled, self.state_index = pooled
+
+    def __len__(self):
+        return len(self.parameters)
+
+    def emission(self, frames):
+        """Per group functions of t giving its G x B x N densities of frame t, T_max x B (x D) frames
+
+        tied models evaluate each distinct gaussian once for the whole batch, every frame after that
+        is a gather. Other parameter types are evaluated per model
+        """
+        if self.pooled is not None:
+            pooled = self.pooled.emission(frames, state_axis=-1) # T x B x U
+            return [pooled_emission(pooled, np.stack([self.state_index[index] for index in group.indices]))
+                    for group in self.groups]
+
+        return [stacked_emission([self.parameters[index].emission(frames, state_axis=-1) for index in group.indices])
+                for group in self.groups]
+
+
+def pooled_emission(pooled, state_index):
+    """Function of t gathering a group's G x B x N densities from the T x B x U pooled ones, G x N state_index"""
+    return lambda t: np.moveaxis(pooled[t][:, state_index], 1, 0)
+
+
+def stacked_emission(emissions: list):
+    """Function of t stacking a group's G x B x N densities from each model's T x B x N"""
+    return lambda t: np.stack([emission[t] for emission in emissions])
+
+
+def score_batch(model_set: ModelSet, observations, lengths, beam: float = None):
+    """Scaled forward passes of every model over one padded B x T_max (x D) batch, see score()"""
+    frames = np.swapaxes(observations, 0, 1)
+    emissions = model_set.emission(frames)
+    alphas = [np.zeros((len(group), len(lengths), group.state_count)) for group in model_set.groups]
+
+    log_likelihood = np.zeros((len(model_set), len(lengths)))
+    rejected = np.zeros((len(model_set), len(lengths)), dtype=bool)
+
+    with np.errstate(divide='ignore', invalid='ignore'): # impossible sequences go to -inf
+        for t in range(frames.shape[0]):
+            live = ~np.all(rejected, axis=1) # models with any sequence left to score
+            if not np.any(live):
+                break
+
+            # finished/rejected sequences keep a unit scale
+            active = (t < lengths)[np.newaxis, :] & ~rejected
+            ending = active & (t == lengths - 1)[np.newaxis, :]
+
+            for group, emission, alpha in zip(model_set.groups, emissions, alphas):
+                rows = live[group.indices]
+                if not np.any(rows):
+                    continue
+
+                if t == 0:
+                    column = group.entry[:, np.newaxis, :] * emission(0)
+                else:
+                    # every live model of the group at once
+                    column = np.zeros_like(alpha)
+                    column[rows] = group.forward(alpha[rows], rows) * emission(t)[rows]
+
+                group_active = active[group.indices]
+                scale = np.where(group_active, np.sum(column, axis=2), 1.)
+                alpha[:] = np.where((scale > 0)[:, :, np.newaxis], column / scale[:, :, np.newaxis], 0.)
+                group_likelihood = log_likelihood[group.indices] + np.log(scale)
+
+                # exit probs at each sequence's own last frame
+                group_ending = ending[group.indices]
+                exit_likelihood = np.log(np.sum(alpha * group.exit[:, np.newaxis, :], axis=2))
+                group_likelihood[group_ending] += exit_likelihood[group_ending]
+                log_likelihood[group.indices] = group_likelihood
+
+            if beam is not None:
+                # running ln(P(o_1..o_t|model)) per sequence, anything beam behind the leader is dropped
+                running = np.where(active, log_likelihood, -np.inf)
+                leader = np.max(running, axis=0)
+                rejected |= active & ~ending & (running < leader - beam)
+
+    log_likelihood[rejected] = -np.inf
+    return log_likelihood, rejected
+
+
+def score(models: list, sequences: list, beam: float = None, batch_size: int = 64):
+    """ln(P(O|model)) for every model and sequence, M x S, forward passes only
+
+    models are (states, state_transitions) pairs or TrainingResults, sequences are scored batch_size
+    at a time (similar lengths together). beam rejects a model for a sequence as soon as its running
+    log likelihood falls more than beam behind the best model's, their score is then -inf. Prefix
+    likelihoods ignore the exit probs so a narrow beam can drop the eventual winner, keep it wide
+    compared with the per frame spread between models
+    """
+    model_set = ModelSet(models)
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=int)
+    check_lengths(lengths) # before sorting, so the error names the caller's index
+    order = np.argsort(lengths, kind='stable')
+
+    log_likelihood = np.zeros((len(model_set), len(sequences)))
+    rejected = np.zeros((len(model_set), len(sequences)), dtype=bool)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        observations, batch_lengths = pad_sequences([sequences[index] for index in batch])
+        log_likelihood[:, batch], rejected[:, batch] = score_batch(model_set, observations, batch_lengths, beam=beam)
+
+    return ScoreResult(log_likelihood=log_likelihood, rejected=rejected)
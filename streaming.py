@@ -0,0 +1,56 @@
+import numpy as np
+
+from parameters import as_state_parameters
+from topology import as_transitions
+
+
+class OnlineForwardFilter:
+    """Incremental forward filter for live observations, keeps only the current forward column
+
+    Each frame's column is normalised as in MarkovModel.populate(scaled=True) so memory per stream
+    is constant and long streams don't underflow, ln(P(o_1..o_t|model)) is the running sum of ln(c_t)
+    """
+
+    def __init__(self, states: list, state_transitions: np.ndarray):
+        self.parameters = as_state_parameters(states)
+        self.transitions = as_transitions(state_transitions)
+        length = len(self.parameters)
+
+        self.entry_probabilities = self.transitions.entry
+        self.exit_probabilities = self.transitions.exit
+
+        self.posterior = np.zeros(length) # P(state at t|o_1..o_t)
+        self._column = np.zeros(length)
+        self.reset()
+
+    def reset(self):
+        """Start a new stream, keeps the model parameters and buffers"""
+        self.posterior[:] = 0
+        self.log_likelihood = 0. # ln(P(o_1..o_t|model)), no exit probs
+        self.frames = 0
+
+    def update(self, frames):
+        """Consume one frame or a chunk of frames, returns (filtered state posterior, running log likelihood)"""
+
+        frames = np.asarray(frames, dtype=float).reshape((-1,) + self.parameters.feature_shape)
+        emission = self.parameters.emission(frames, state_axis=-1)
+
+        for frame_emission in emission:
+            if self.frames == 0:
+                np.multiply(self.entry_probabilities, frame_emission, out=self._column)
+            else:
+                # sum_i( alpha_i(t-1) * a_ij ) * b_j(o_t)
+                np.multiply(self.transitions.forward(self.posterior), frame_emission, out=self._column)
+
+            scale = np.sum(self._column)
+            np.divide(self._column, scale, out=self.posterior)
+            self.log_likelihood += np.log(scale)
+            self.frames += 1
+
+        return self.posterior.copy(), self.log_likelihood
+
+    def final_log_likelihood(self):
+        """ln(P(O|model)) for everything seen so far as a complete sequence, includes exit probs"""
+        if self.frames == 0:
+            return -np.inf
+        return self.log_likelihood + np.log(self.posterior @ self.exit_probabilities)
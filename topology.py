@@ -0,0 +1,275 @@
+from dataclasses import dataclass, field
+from functools import cached_property
+
+import numpy as np
+
+from maths import logsumexp
+
+
+def floating(values):
+    """Array of values, kept in its own float precision (float32 stays float32) otherwise float64"""
+    values = np.asarray(values)
+    return values if np.issubdtype(values.dtype, np.floating) else values.astype(float)
+
+
+def source_aligned(values, offset: int, fill: float = 0.):
+    """Shift the last (state) axis so index j holds values[j - offset], vacated states get fill"""
+    length = values.shape[-1]
+    aligned = np.full_like(values, fill)
+
+    if offset >= 0:
+        aligned[..., offset:] = values[..., :length - offset]
+    else:
+        aligned[..., :length + offset] = values[..., -offset:]
+    return aligned
+
+
+class DenseTransitions:
+    """Padded (N + 2) x (N + 2) state transitions, entry row, a_ij block and exit column
+
+    Shares its interface with BandedTransitions so the engines don't care which topology they run
+    """
+
+    def __init__(self, state_transitions):
+        self.padded = floating(state_transitions)
+
+    @property
+    def state_count(self):
+        return len(self.padded) - 2
+
+    @property
+    def entry(self):
+        return self.padded[0, 1:self.state_count + 1]
+
+    @property
+    def exit(self):
+        return self.padded[1:self.state_count + 1, -1]
+
+    @property
+    def matrix(self):
+        return self.padded[1:self.state_count + 1, 1:self.state_count + 1]
+
+    def forward(self, values):
+        """sum_i( values_i * a_ij ) over the last axis, ... x N"""
+        return values @ self.matrix
+
+    def backward(self, values):
+        """sum_j( a_ij * values_j ) over the last axis, ... x N"""
+        return values @ self.matrix.T
+
+    @cached_property
+    def log_matrix(self):
+        with np.errstate(divide='ignore'): # structural zeros become -inf
+            return np.log(self.matrix)
+
+    def log_forward(self, log_values):
+        """Log domain forward step, ln( sum_i( exp(log_values_i) * a_ij ) ) for every state j"""
+        return logsumexp(log_values[:, np.newaxis] + self.log_matrix, axis=0)
+
+    def log_backward(self, log_values):
+        """Log domain backward step, ln( sum_j( a_ij * exp(log_values_j) ) ) for every state i"""
+        return logsumexp(self.log_matrix + log_values[np.newaxis, :], axis=1)
+
+    def max_forward(self, log_values):
+        """Viterbi step, (max_i( log_values_i + ln(a_ij) ), best i) for every state j"""
+        candidates = log_values[:, np.newaxis] + self.log_matrix
+
+        best_from = np.argmax(candidates, axis=0)
+        return candidates[best_from, np.arange(self.state_count)], best_from
+
+    def transition_sums(self, forward, weighted_backward):
+        """a_ij * sum_t( forward_i(t - 1) * weighted_backward_j(t) ) from frames x N arrays"""
+        return self.matrix * (forward.T @ weighted_backward)
+
+    def log_transition_sums(self, log_forward, log_weighted_backward, log_likelihood: float):
+        """transition_sums() from log domain frames x N arrays, xi summed out of the log domain
+
+        each frame is shifted by its max so exp() stays in range, one N x N matmul for every frame
+        """
+        forward_shift = np.max(log_forward, axis=1, keepdims=True)
+        backward_shift = np.max(log_weighted_backward, axis=1, keepdims=True)
+        frame_weight = np.exp(forward_shift + backward_shift - log_likelihood)
+
+        return self.transition_sums(np.exp(log_forward - forward_shift) * frame_weight,
+                                    np.exp(log_weighted_backward - backward_shift))
+
+    def band(self, matrix):
+        """Dense N x N values in this topology's storage layout (already dense)"""
+        return matrix
+
+    def to_matrix(self, values):
+        """Values in this topology's storage layout as a dense N x N matrix"""
+        return values
+
+    def reestimated(self, statistics):
+        """New padded state transitions from summed BaumWelchStatistics"""
+        return statistics.reestimated_state_transitions()
+
+    def astype(self, dtype):
+        """Same transitions in another float precision, for the recursions to match their lattices"""
+        if self.padded.dtype == dtype:
+            return self
+        return DenseTransitions(self.padded.astype(dtype))
+
+    def refreshed(self):
+        """Same values as a new object, so the log matrix is recomputed after in-place edits"""
+        return DenseTransitions(self.padded)
+
+
+@dataclass(frozen=True)
+class BandedTransitions:
+    """State transitions stored by diagonal, only allowed arcs are kept or computed
+
+    bands[i, k] = a_i,i+offsets[k], so a left-to-right model is offsets (0, 1) and a Bakis model
+    (0, 1, 2). Every recursion step is O(N * K) for K diagonals instead of O(N^2), re-estimation
+    returns the same pattern
+    """
+    entry: np.ndarray  # pi, N
+    bands: np.ndarray  # N x K
+    offsets: np.ndarray  # K, to_index - from_index of each diagonal
+    exit: np.ndarray  # eta, N
+
+    log_bands: np.ndarray = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        offsets = np.asarray(self.offsets, dtype=int)
+        bands = floating(self.bands).copy()
+
+        # arcs that would leave the model are structural zeros
+        to_index = np.arange(len(bands))[:, np.newaxis] + offsets
+        bands[(to_index < 0) | (to_index >= len(bands))] = 0.
+
+        object.__setattr__(self, 'entry', floating(self.entry))
+        object.__setattr__(self, 'bands', bands)
+        object.__setattr__(self, 'offsets', offsets)
+        object.__setattr__(self, 'exit', floating(self.exit))
+        with np.errstate(divide='ignore'):
+            object.__setattr__(self, 'log_bands', np.log(bands))
+
+    @classmethod
+    def from_dense(cls, state_transitions, offsets=None):
+        """Band a padded (N + 2) x (N + 2) matrix, by default keeping every diagonal with a nonzero arc"""
+        state_transitions = np.asarray(state_transitions, dtype=float)
+        length = len(state_transitions) - 2
+        matrix = state_transitions[1:length + 1, 1:length + 1]
+
+        if offsets is None:
+            from_index, to_index = np.nonzero(matrix)
+            offsets = np.unique(to_index - from_index)
+
+        return cls(entry=state_transitions[0, 1:length + 1],
+                   bands=band_matrix(matrix, offsets),
+                   offsets=offsets,
+                   exit=state_transitions[1:length + 1, -1])
+
+    @property
+    def state_count(self):
+        return len(self.bands)
+
+    @cached_property
+    def matrix(self):
+        """Dense N x N a_ij, only built for callers that need the full matrix"""
+        return self.to_matrix(self.bands)
+
+    @cached_property
+    def padded(self):
+        """Dense padded (N + 2) x (N + 2) equivalent"""
+        length = self.state_count
+        padded = np.zeros((length + 2, length + 2), dtype=self.bands.dtype)
+        padded[0, 1:length + 1] = self.entry
+        padded[1:length + 1, 1:length + 1] = self.matrix
+        padded[1:length + 1, -1] = self.exit
+        return padded
+
+    def forward(self, values):
+        """sum_i( values_i * a_ij ) over the last axis, one shifted multiply-add per diagonal"""
+        result = np.zeros_like(values)
+        for k, offset in enumerate(self.offsets):
+            result += source_aligned(values * self.bands[:, k], offset)
+        return result
+
+    def backward(self, values):
+        """sum_j( a_ij * values_j ) over the last axis, one shifted multiply-add per diagonal"""
+        result = np.zeros_like(values)
+        for k, offset in enumerate(self.offsets):
+            result += self.bands[:, k] * source_aligned(values, -offset)
+        return result
+
+    def log_forward(self, log_values):
+        """Log domain forward step over allowed arcs only, one shifted diagonal per band then logsumexp over K"""
+        return logsumexp(np.stack([source_aligned(log_values + self.log_bands[:, k], offset, fill=-np.inf)
+                                   for k, offset in enumerate(self.offsets)]), axis=0)
+
+    def log_backward(self, log_values):
+        """Log domain backward step over allowed arcs only, ln( sum_j( a_ij * exp(log_values_j) ) )"""
+        return logsumexp(np.stack([self.log_bands[:, k] + source_aligned(log_values, -offset, fill=-np.inf)
+                                   for k, offset in enumerate(self.offsets)]), axis=0)
+
+    def max_forward(self, log_values):
+        """Viterbi step over allowed arcs only, (best score, best from index) for every state"""
+        candidates = np.stack([source_aligned(log_values + self.log_bands[:, k], offset, fill=-np.inf)
+                               for k, offset in enumerate(self.offsets)])
+
+        best_band = np.argmax(candidates, axis=0)
+        to_index = np.arange(self.state_count)
+        return candidates[best_band, to_index], to_index - self.offsets[best_band]
+
+    def transition_sums(self, forward, weighted_backward):
+        """N x K band of a_ij * sum_t( forward_i(t - 1) * weighted_backward_j(t) ), allowed arcs only"""
+        sums = np.zeros_like(self.bands)
+        for k, offset in enumerate(self.offsets):
+            sums[:, k] = self.bands[:, k] * np.sum(forward * source_aligned(weighted_backward, -offset), axis=0)
+        return sums
+
+    def log_transition_sums(self, log_forward, log_weighted_backward, log_likelihood: float):
+        """N x K band of transition_sums() from log domain frames x N arrays, each diagonal logsumexp'd over frames"""
+        sums = np.zeros(self.bands.shape)
+        for k, offset in enumerate(self.offsets):
+            log_xi = log_forward + source_aligned(log_weighted_backward, -offset, fill=-np.inf) + self.log_bands[:, k]
+            sums[:, k] = np.exp(logsumexp(log_xi, axis=0) - log_likelihood)
+        return sums
+
+    def band(self, matrix):
+        return band_matrix(matrix, self.offsets)
+
+    def to_matrix(self, values):
+        length = self.state_count
+        matrix = np.zeros((length, length), dtype=np.result_type(values))
+        for k, offset in enumerate(self.offsets):
+            from_index = np.arange(max(0, -offset), min(length, length - offset))
+            matrix[from_index, from_index + offset] = values[from_index, k]
+        return matrix
+
+    def astype(self, dtype):
+        if self.bands.dtype == dtype:
+            return self
+        return BandedTransitions(entry=self.entry.astype(dtype), bands=self.bands.astype(dtype),
+                                 offsets=self.offsets, exit=self.exit.astype(dtype))
+
+    def refreshed(self):
+        """Same values as a new object, so log bands, matrix and padded are recomputed after in-place edits"""
+        return BandedTransitions(entry=self.entry, bands=self.bands, offsets=self.offsets, exit=self.exit)
+
+    def reestimated(self, statistics):
+        """New banded transitions from summed BaumWelchStatistics, keeps the sparsity pattern"""
+        return BandedTransitions(entry=statistics.entry / statistics.sequences,
+                                 bands=statistics.transitions / statistics.occupation[:, np.newaxis],
+                                 offsets=self.offsets,
+                                 exit=statistics.exit / statistics.occupation)
+
+
+def band_matrix(matrix, offsets):
+    """N x K diagonals of a dense N x N matrix, entries past the edges are zero"""
+    length = len(matrix)
+    bands = np.zeros((length, len(offsets)))
+    for k, offset in enumerate(offsets):
+        from_index = np.arange(max(0, -offset), min(length, length - offset))
+        bands[from_index, k] = matrix[from_index, from_index + offset]
+    return bands
+
+
+def as_transitions(state_transitions):
+    """Accept a topology object or a padded transition matrix"""
+    if isinstance(state_transitions, (DenseTransitions, BandedTransitions)):
+        return state_transitions
+    return DenseTransitions(state_transitions)
@@ -0,0 +1,126 @@
+from dataclasses import dataclass
+from time import perf_counter
+
+import numpy as np
+
+from batch import BatchMarkovModel
+from parameters import StateParameters, as_state_parameters
+from profiling import profiled
+from topology import BandedTransitions, as_transitions
+
+
+@dataclass(frozen=True)
+class TrainingTrace:
+    """Per-iteration record of a training run, row i = parameters going into iteration i"""
+    log_likelihood: np.ndarray  # ln(P(O|model)) summed over sequences, iterations
+    means: np.ndarray  # iterations x N
+    variances: np.ndarray  # iterations x N
+    elapsed: np.ndarray  # seconds since start at the end of each iteration
+    converged: bool
+
+    @property
+    def iterations(self):
+        return len(self.log_likelihood)
+
+
+@dataclass(frozen=True)
+class TrainingResult:
+    parameters: StateParameters
+    state_transitions: np.ndarray  # padded, or BandedTransitions when trained banded
+    trace: TrainingTrace
+
+    @property
+    def states(self):
+        """Trained parameters as State dataclasses, entry/exit from the trained transitions"""
+        return self.parameters.to_states(as_transitions(self.state_transitions).padded)
+
+
+def is_single_sequence(sequences, feature_shape: tuple = ()):
+    """True when given one sequence of observations rather than a list of sequences"""
+    return len(sequences) > 0 and np.ndim(sequences[0]) == len(feature_shape)
+
+
+def baum_welch(expectation, states: list, state_transitions: np.ndarray,
+               max_iterations: int = 50, tolerance: float = 1e-4, time_budget: float = None,
+               callback=None, profiler=None):
+    """Iterate Baum-Welch re-estimation around any E-step until ln(P(O|model)) stops improving
+
+    expectation(parameters, state_transitions) returns (BaumWelchStatistics, log likelihood) for the whole
+    training set, stops when an iteration improves the log likelihood by less than tolerance, after
+    max_iterations or once time_budget seconds are spent. callback(iteration, log_likelihood, parameters,
+    state_transitions) is called after every update. A BandedTransitions is re-estimated as banded.
+    A profiling.Profiler times the expectation/maximisation phases and records every iteration.
+    """
+
+    parameters = as_state_parameters(states)
+    if not isinstance(state_transitions, BandedTransitions): # banded are frozen, dense copied
+        state_transitions = np.array(state_transitions, dtype=float)
+
+    log_likelihoods = []
+    means = []
+    variances = []
+    elapsed = []
+    converged = False
+    start = perf_counter()
+
+    for iteration in range(max_iterations):
+        iteration_start = perf_counter()
+        with profiled(profiler, 'expectation'):
+            statistics, log_likelihood = expectation(parameters, state_transitions)
+
+        log_likelihoods.append(log_likelihood)
+        means.append(parameters.means)
+        variances.append(parameters.variances)
+
+        # NEW PARAMETERS
+        with profiled(profiler, 'maximisation'):
+            state_transitions = as_transitions(state_transitions).reestimated(statistics)
+            parameters = parameters.reestimated(statistics)
+
+        finish = perf_counter()
+        elapsed.append(finish - start)
+        if profiler is not None:
+            profiler.iteration(iteration, log_likelihood, finish - iteration_start)
+        if callback is not None:
+            callback(iteration, log_likelihood, parameters, state_transitions)
+
+        if iteration > 0 and log_likelihood - log_likelihoods[-2] < tolerance:
+            converged = True
+            break
+        if time_budget is not None and elapsed[-1] >= time_budget:
+            break
+
+    trace = TrainingTrace(log_likelihood=np.array(log_likelihoods),
+                          means=np.array(means),
+                          variances=np.array(variances),
+                          elapsed=np.array(elapsed),
+                          converged=converged)
+
+    return TrainingResult(parameters=parameters, state_transitions=state_transitions, trace=trace)
+
+
+def fit(states: list, sequences: list, state_transitions: np.ndarray,
+        max_iterations: int = 50, tolerance: float = 1e-4, time_budget: float = None,
+        callback=None, profiler=None, dtype=float):
+    """Baum-Welch train from initial states/transitions until ln(P(O|model)) stops improving
+
+    sequences is either one observation sequence or a list of them, see baum_welch() for the stopping
+    rules, callback and profiler. dtype is the lattice precision, re-estimation always sums in float64.
+    The given states and state_transitions are never modified.
+    """
+
+    if is_single_sequence(sequences, as_state_parameters(states).feature_shape):
+        sequences = [sequences]
+
+    # lattice buffers allocated once, only the parameters change between iterations
+    model = BatchMarkovModel(states, sequences, state_transitions, profiler=profiler, dtype=dtype)
+
+    def expectation(parameters, state_transitions):
+        model.states = parameters
+        model.state_transitions = state_transitions
+        model.populate()
+        return model.accumulate(), model.observation_likelihood
+
+    return baum_welch(expectation, states, state_transitions,
+                      max_iterations=max_iterations, tolerance=tolerance, 
+                      time_budget=time_budget, callback=callback, profiler=profiler)
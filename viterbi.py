@@ -0,0 +1,66 @@
+from dataclasses import dataclass
+
+import numpy as np
+from numpy import log as ln
+
+from parameters import as_state_parameters
+from topology import as_transitions
+
+
+@dataclass(frozen=True)
+class ViterbiResult:
+    log_likelihood: float  # ln( P(O, best path|model) ), includes entry and exit probs
+    path: np.ndarray = None  # best state index for every observation, None when only scoring
+
+
+def backpointer_dtype(state_count: int):
+    """Smallest unsigned integer type that can hold every state index"""
+    return np.min_scalar_type(max(state_count - 1, 0))
+
+
+def viterbi(states: list, observations: list, state_transitions: np.ndarray, path: bool = True):
+    """Most likely state sequence through the model, one max-plus pass in the log domain
+
+    path=False skips the backpointers entirely and only returns the best path's score, a BandedTransitions
+    only ever compares its allowed arcs
+    """
+
+    observations = np.asarray(observations, dtype=float)
+    length = len(states)
+    if len(observations) == 0:
+        return ViterbiResult(log_likelihood=-np.inf, path=np.zeros(0, dtype=backpointer_dtype(length)) if path else None)
+
+    transitions = as_transitions(state_transitions)
+    with np.errstate(divide='ignore'): # structural zeros become -inf
+        log_pi = ln(transitions.entry)
+        log_eta = ln(transitions.exit)
+
+    emission = as_state_parameters(states).log_emission(observations)
+
+    if path:
+        backpointers = np.empty((len(observations) - 1, length), dtype=backpointer_dtype(length))
+
+    # ln(pi) + ln(b)
+    delta = log_pi + emission[:, 0]
+
+    for t in range(1, len(observations)):
+        # best way into each state j, max_i( delta_i(t-1) + ln(a_ij) )
+        best, best_from = transitions.max_forward(delta)
+
+        if path:
+            backpointers[t - 1] = best_from
+        delta = best + emission[:, t]
+
+    final = delta + log_eta
+    best_final = int(np.argmax(final))
+
+    if not path:
+        return ViterbiResult(log_likelihood=final[best_final])
+
+    # walk the backpointers from the best exiting state
+    best_path = np.empty(len(observations), dtype=backpointer_dtype(length))
+    best_path[-1] = best_final
+    for t in range(len(observations) - 1, 0, -1):
+        best_path[t - 1] = backpointers[t - 1, best_path[t]]
+
+    return ViterbiResult(log_likelihood=final[best_final], path=best_path)